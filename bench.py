@@ -0,0 +1,735 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the hot paths of qq3.
+
+Run it from the directory with the game assets, like qq3.py itself:
+
+    python bench.py            # every benchmark
+    python bench.py render     # only the named ones
+    python bench.py --save results/today.json --compare results/last.json
+
+--save writes every result to a JSON file, --compare shows the change
+from the results in one.
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy
+import pygame
+
+import headless
+import qq3
+from headless import HeldKeys
+
+MAP_KEY = """
+[X]
+name = wall
+wall = true
+block = true
+
+[.]
+name = floor
+tile = 0, 3
+
+[@]
+name = player
+tile = 0, 3
+player = true
+sprite = player.png
+
+[>]
+name = bush
+tile = 2, 3
+sprite = bush.png
+block = true
+
+[b]
+name = crate
+tile = 0, 3
+sprite = crate.png
+block = true
+
+[s]
+name = skeleton
+tile = 0, 3
+sprite = skeleton.png
+block = true
+goal = player
+"""
+
+BENCHMARKS = {}
+# What report() was given, and the results of an earlier run by (name, size).
+RESULTS = []
+BASELINE = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def generate_map(width, height, seed=0, walls=0.15, bushes=0.02, walkers=0,
+                 crates=0):
+    """Return the text of a random map in the level.map format."""
+    rng = numpy.random.RandomState(seed)
+    cells = numpy.full((height, width), ord('.'), dtype=numpy.uint8)
+    roll = rng.random_sample((height, width))
+    cells[roll < walls + bushes] = ord('>')
+    cells[roll < walls] = ord('X')
+    cells[(roll >= walls + bushes) & (roll < walls + bushes + walkers)] = ord('s')
+    crates += walls + bushes + walkers
+    cells[(roll >= walls + bushes + walkers) & (roll < crates)] = ord('b')
+    cells[0] = cells[-1] = cells[:, 0] = cells[:, -1] = ord('X')
+    cells[1, 1] = ord('@')
+    cells[1, 2] = ord('b')
+    rows = [row.tobytes().decode('ascii') for row in cells]
+    return ("[level]\ntileset = ground.png\nmap = " + "\n\t".join(rows) +
+            "\n" + MAP_KEY)
+
+
+def map_rows(width, height, seed=0, walls=0.15, bushes=0.02):
+    """Return a rows(y, count) function for write_streamed(), giving the
+    rows of a random map that is made as they are asked for."""
+    def rows(y, count):
+        rng = numpy.random.RandomState((seed, y))
+        cells = numpy.full((count, width), ord('.'), dtype=numpy.uint8)
+        roll = rng.random_sample((count, width))
+        cells[roll < walls + bushes] = ord('>')
+        cells[roll < walls] = ord('X')
+        cells[:, 0] = cells[:, -1] = ord('X')
+        if y == 0:
+            cells[0] = ord('X')
+            cells[1, 1] = ord('@')
+            cells[1, 2] = ord('b')
+        if y + count == height:
+            cells[-1] = ord('X')
+        return [row.tobytes().decode('ascii') for row in cells]
+    return rows
+
+
+def write_map(width, height, **kwargs):
+    """Write a generated map to a temporary file and return its name."""
+    handle, filename = tempfile.mkstemp(suffix=".map")
+    with os.fdopen(handle, "w") as f:
+        f.write(generate_map(width, height, **kwargs))
+    return filename
+
+
+def load_map(width, height, **kwargs):
+    filename = write_map(width, height, **kwargs)
+    try:
+        return qq3.Level(filename, cache=False)
+    finally:
+        os.remove(filename)
+
+
+def timeit(func, repeat=3):
+    """Return the best wall time of func over a few runs, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, size, seconds, note=""):
+    ms = seconds * 1000
+    old = BASELINE.get((name, str(size)))
+    if old:
+        note = "{0:+.0%} {1}".format(ms / old - 1, note).rstrip()
+    print("{0:<28} {1:>12} {2:>12.3f} ms  {3}".format(name, size, ms, note))
+    RESULTS.append({"name": name, "size": str(size), "ms": ms, "note": note})
+
+
+def report_count(name, size, count, unit):
+    """Like report(), for a number that is not a time."""
+    old = BASELINE.get((name, str(size)))
+    note = "{0:+.0%}".format(count / old - 1) if old else ""
+    print("{0:<28} {1:>12} {2:>12.0f} {3:<3} {4}".format(name, size, count, unit, note))
+    RESULTS.append({"name": name, "size": str(size), "value": count,
+                    "unit": unit, "note": note})
+
+
+def save_results(filename):
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump({"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(),
+                   "pygame": pygame.version.ver,
+                   "machine": platform.machine(),
+                   "results": RESULTS}, f, indent=1)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        results = json.load(f)["results"]
+    return dict(((result["name"], result["size"]),
+                 result["ms"] if "ms" in result else result["value"])
+                for result in results)
+
+
+def same_surface(a, b):
+    return pygame.image.tobytes(a, "RGB") == pygame.image.tobytes(b, "RGB")
+
+
+@benchmark
+def render():
+    # Full renders allocate the whole map as one surface, so the biggest
+    # sizes only time the autotiling and one screen-sized region.
+    for size in (100, 300):
+        level = load_map(size, size)
+        image, overlays = level.render()
+        fast_image, fast_overlays = level.render_vectorized()
+        same = (same_surface(image, fast_image) and
+                overlays.keys() == fast_overlays.keys() and
+                all(overlays[pos] is fast_overlays[pos] for pos in overlays))
+        label = "{0}x{0}".format(size)
+        report("render", label, timeit(level.render))
+        report("render_vectorized", label,
+               timeit(level.render_vectorized),
+               "identical" if same else "DIFFERENT")
+    for size in (100, 1000, 4000):
+        level = load_map(size, size)
+        label = "{0}x{0}".format(size)
+
+        def autotile():
+            level._autotile = None
+            level.autotile()
+        report("autotile", label, timeit(autotile))
+        report("render_region 35x23", label,
+               timeit(lambda: level.render_region(0, 0, 35, 23)))
+
+
+@benchmark
+def stream():
+    # The same farm as a map file and as a streamed level: opening it and
+    # a screen's worth of use, then a game on it and its first frame, with
+    # the Python memory that takes.
+    folder = tempfile.mkdtemp()
+    try:
+        for size, walls, bushes in ((1000, 0.15, 0.02), (4000, 0.01, 0.001)):
+            label = "{0}x{0}".format(size)
+            rows = map_rows(size, size, walls=walls, bushes=bushes)
+            text = os.path.join(folder, "level.map")
+            streamed = os.path.join(folder, "level.qmap")
+            with open(text, "w") as f:
+                f.write("[level]\ntileset = ground.png\nmap = " +
+                        "\n\t".join(rows(0, size)) + "\n" + MAP_KEY)
+            report("write_streamed", label,
+                   timeit(lambda: qq3.convert_level(text, streamed), 1),
+                   "{0:.1f} MB file".format(os.path.getsize(streamed) / 2 ** 20))
+            for name, open_level in (("Level", lambda: qq3.Level(text, cache=False)),
+                                     ("StreamedLevel", lambda: qq3.StreamedLevel(streamed))):
+                def visit():
+                    level = open_level()
+                    level.render_region(size // 2, size // 2, 35, 23)
+                    for y in range(size // 2, size // 2 + 23):
+                        for x in range(size // 2, size // 2 + 35):
+                            level.is_blocking(x, y)
+                            level.get_tile(x, y)
+                            (x, y) in level.items
+                    return level
+
+                def play():
+                    game = qq3.Game(open_level())
+                    game.draw_frame(1.0)
+                    game.saves.close()
+                    return game
+                for case, use in (("open+visit", visit), ("Game+frame", play)):
+                    tracemalloc.start()
+                    kept = use()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    del kept
+                    report(name + " " + case, label, timeit(use, 1),
+                           "{0:.0f} KB peak".format(peak / 1024))
+    finally:
+        shutil.rmtree(folder, True)
+
+
+@benchmark
+def tiles():
+    sheets = ["player.png", "bush.png", "crate.png", "stop.png",
+              "forward.png", "backward.png", "skeleton.png", "shadow.png"]
+    report("TileCache sheets", "{0} files".format(len(sheets)), timeit(
+        lambda: [qq3.TileCache()[name] for name in sheets]))
+    report("TileCache.pack", "{0} files".format(len(sheets)), timeit(
+        lambda: qq3.TileCache().pack(sheets)))
+    report("TileCache tileset", "ground.png", timeit(
+        lambda: qq3.TileCache(qq3.MAP_TILE_WIDTH, qq3.MAP_TILE_HEIGHT)["ground.png"]))
+
+
+@benchmark
+def level():
+    # Parsing the map, the first load that also compiles it, and loads of
+    # the compiled copy, each in a new folder so the cache starts empty.
+    for size in (100, 1000, 4000):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, "level.map")
+            with open(filename, "w") as f:
+                f.write(generate_map(size, size))
+            label = "{0}x{0}".format(size)
+
+            def cold():
+                shutil.rmtree(os.path.join(folder, qq3.LEVEL_CACHE_DIR), True)
+                qq3.Level(filename).autotile()
+            report("level parse", label,
+                   timeit(lambda: qq3.Level(filename, cache=False).autotile()))
+            report("level compile", label, timeit(cold))
+            report("level compiled", label,
+                   timeit(lambda: qq3.Level(filename).autotile()))
+        finally:
+            shutil.rmtree(folder, True)
+
+
+@benchmark
+def hud():
+    frames = 1000
+    screen = pygame.display.get_surface()
+    values = [(potato // 10 * 10, potato // 15) for potato in range(frames)]
+
+    def before():
+        # What Game.main did every frame: a new font and four renders.
+        for potato, time_left in values:
+            font = pygame.font.SysFont(*qq3.HUD_FONT)
+            for text in ("P O T A T O  {0}".format(potato),
+                         "T I M E  L E F T  {0}".format(time_left),
+                         "D O N A T E D  {0}".format(0),
+                         "G O A L  {0}".format(1000)):
+                screen.blit(font.render(text, 1, (255, 255, 255)), (5, 210))
+
+    def after():
+        hud = qq3.Hud()
+        for potato, time_left in values:
+            hud.begin()
+            hud.show("potato", "P O T A T O  {0}".format(potato),
+                     (5, 210), (255, 255, 255))
+            hud.show("time", "T I M E  L E F T  {0}".format(time_left),
+                     (5, 230), (255, 255, 255))
+            hud.show("donated", "D O N A T E D  {0}".format(0),
+                     (5, 250), (255, 255, 255))
+            hud.show("goal", "G O A L  {0}".format(1000),
+                     (5, 270), (255, 255, 255))
+            for area in qq3.merge_rects(hud.changed()):
+                hud.draw(screen, area)
+    report("hud SysFont per frame", "per frame", timeit(before) / frames)
+    report("hud cached", "per frame", timeit(after) / frames)
+
+
+class SortedUpdates(pygame.sprite.RenderUpdates):
+    # The sprite group the game drew with before the render list, keeping
+    # its sprites in depth order as they are added and removed. Sprites of
+    # equal depth keep the order they were added in.
+
+    def __init__(self, *sprites):
+        self._keys = []
+        self._sorted = []
+        self._added = {}
+        self._count = 0
+        pygame.sprite.RenderUpdates.__init__(self, *sprites)
+
+    def add_internal(self, sprite, layer=None):
+        pygame.sprite.RenderUpdates.add_internal(self, sprite)
+        self._count += 1
+        self._added[sprite] = self._count
+        key = sprite.depth, self._count
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._sorted.insert(index, sprite)
+
+    def remove_internal(self, sprite):
+        pygame.sprite.RenderUpdates.remove_internal(self, sprite)
+        index = bisect.bisect_left(self._keys, (sprite.depth, self._added.pop(sprite)))
+        del self._keys[index]
+        del self._sorted[index]
+
+    def sprites(self):
+        return list(self._sorted)
+
+
+def resorting_gather(render_list, view, alpha=1.0):
+    # RenderList.gather() sorting everything under view on every call.
+    found = [(key, sprite, sprite.image, sprite.rect)
+             for sprite, key in render_list.still.items()
+             if sprite.rect.colliderect(view)]
+    for layer, order, sprite in render_list.moving:
+        rect = sprite.shown_rect(alpha)
+        if rect.colliderect(view):
+            depth = rect.bottom if layer == render_list.SPRITES else 0
+            found.append(((layer, depth, order), sprite, sprite.image, rect))
+    found.sort(key=lambda entry: entry[0])
+    return [entry[1:] for entry in found]
+
+
+@benchmark
+def sprites():
+    # Finding the sprites under the camera in drawing order, with one of
+    # them moving like the player.
+    view = pygame.display.get_surface().get_rect()
+    image = pygame.Surface((32, 32))
+    rng = numpy.random.RandomState(0)
+    frames = 100
+    for count in (100, 1000, 10000):
+        render_list = qq3.RenderList()
+        positions = rng.randint(0, 35, size=(count, 2)).tolist()
+        for pos in positions[1:]:
+            render_list.add(qq3.Sprite(pos, [[image]]), qq3.RenderList.SPRITES)
+        player = qq3.Sprite(positions[0], [[image]])
+        render_list.add(player, qq3.RenderList.SPRITES, moves=True)
+
+        def walk(step):
+            player.move(0, 2 if step % 20 < 10 else -2)
+
+        def gather():
+            for step in range(frames):
+                walk(step)
+                render_list.gather(view)
+
+        def resort():
+            for step in range(frames):
+                walk(step)
+                resorting_gather(render_list, view)
+        label = "{0} sprites".format(count)
+        report("RenderList.gather", label, timeit(gather) / frames)
+        report("gather and sort", label, timeit(resort) / frames)
+        if render_list.gather(view) != resorting_gather(render_list, view):
+            print("    WRONG ORDER")
+
+
+def linear_lookup(interact, bushstuff, pos):
+    # How interact() used to find what is next to the player.
+    found = []
+    for i in interact:
+        if pos in i[1]:
+            bush = None
+            if i[0] == 'bush':
+                for j in bushstuff:
+                    if pos in j[0]:
+                        bush = bushstuff.index(j)
+            found.append((i[0], bush))
+    return found
+
+
+@benchmark
+def interact():
+    presses = 100
+    for size in (35, 100, 300):
+        game = qq3.Game(load_map(size, size, bushes=0.05), headless=True)
+        bushes = [pos for pos, tile in game.level.items.items()
+                  if tile['name'] == 'bush']
+        # Stand below the last bush, the worst case for a linear scan.
+        x, y = bushes[-1]
+        game.player.pos = x, y + 1
+        game.potato = 0
+        # The list of everything to interact with that the game kept.
+        interact = [[tile['name'], [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]]
+                    for (x, y), tile in game.level.items.items()
+                    if tile['name'] in game.features]
+        bushstuff = [[place, False, -1] for name, place in interact
+                     if name == 'bush']
+        label = "{0} bushes".format(len(bushes))
+        report("interact linear scan", label, timeit(
+            lambda: [linear_lookup(interact, bushstuff, (x, y + 1))
+                     for _ in range(presses)]) / presses)
+        keys = HeldKeys(pygame.K_e)
+        report("interact nearby index", label, timeit(
+            lambda: [game.control(keys) for _ in range(presses)]) / presses)
+
+
+def list_grow(bushstuff):
+    # potatogrow() as it was, over [place, is_done, timeleft] lists.
+    for j in bushstuff:
+        if j[1] is False and j[2] > 0:
+            j[2] -= 1
+        if j[2] == 0 and j[1] is not True:
+            j[1] = True
+
+
+@benchmark
+def crops():
+    frames = 100
+    for count in (100, 1000, 10000, 100000):
+        bushstuff = [[None, False, 20 * qq3.FPS if bush % 2 else -1]
+                     for bush in range(count)]
+        field = qq3.CropField()
+        for bush in range(count):
+            field.add()
+            if bush % 2:
+                field.plant(bush)
+        label = "{0} bushes".format(count)
+        report("potatogrow lists", label, timeit(
+            lambda: [list_grow(bushstuff) for _ in range(frames)]) / frames)
+        report("CropField.grow", label, timeit(
+            lambda: [field.grow() for _ in range(frames)]) / frames)
+        report("CropField.shift", label, timeit(lambda: field.shift(-1)))
+
+
+@benchmark
+def sounds():
+    pygame.mixer.init()
+    presses = 20
+    report("Sound() per use", "stoptime.wav", timeit(
+        lambda: [pygame.mixer.Sound("stoptime.wav").play()
+                 for _ in range(presses)]) / presses)
+    bank = qq3.SoundBank(qq3.SOUNDS)
+    report("SoundBank load", "all sounds", bank.load_time,
+           "missing: " + ", ".join(bank.missing) if bank.missing else "")
+    report("SoundBank.play", "stoptime.wav", timeit(
+        lambda: [bank.play("stoptime.wav") for _ in range(presses)])
+        / presses)
+
+
+@benchmark
+def blits():
+    screen = pygame.display.get_surface()
+    files = ["player.png", "bush.png", "crate.png", "stop.png",
+             "forward.png", "backward.png", "skeleton.png"]
+    count = 2000
+
+    def frames(cache):
+        return [frame for name in files for line in cache[name]
+                for frame in line]
+
+    def draw(images, shadow):
+        def run():
+            for i in range(count):
+                screen.blit(shadow, (i % 800, i % 340))
+                screen.blit(images[i % len(images)], (i % 800, i % 340))
+        return run
+    # What the game did: sheets loaded with convert(), a shadow with
+    # set_alpha(64) on its colour key.
+    old = qq3.TileCache()
+    old._load_tile_table = lambda filename, width, height: old._slice(
+        pygame.image.load(filename).convert(), (0, 0), width, height)
+    old_shadow = old["shadow.png"][0][0]
+    old_shadow.set_alpha(64)
+    report("blit sheets", "{0} sprites".format(count),
+           timeit(draw(frames(old), old_shadow)))
+    atlas = qq3.TileCache()
+    atlas.pack(files + ["shadow.png"])
+    report("blit atlas", "{0} sprites".format(count),
+           timeit(draw(frames(atlas), atlas.with_alpha("shadow.png", 64)[0][0])))
+    for name, image in (("blit start.png", pygame.image.load("start.png")),
+                        ("blit start.png converted", qq3.load_image("start.png"))):
+        report(name, "x100", timeit(lambda: [screen.blit(image, (0, 0))
+                                             for _ in range(100)]))
+
+
+@benchmark
+def replay():
+    # Canned sessions, random walks recorded once and played back with
+    # drawing, on the real map and generated ones.
+    levels = [("level.map", qq3.Level())]
+    for size in (200, 1000):
+        levels.append(("{0}x{0}".format(size), load_map(size, size)))
+    for label, level in levels:
+        data = headless.record_session(headless.random_script(300, 0), level,
+                                       needed=10 ** 6)
+        times = numpy.array(headless.replay(data, level, draw=True))
+        p50, p95, p99 = numpy.percentile(times, (50, 95, 99))
+        note = "p95 {0:.3f} ms, p99 {1:.3f} ms, {2} ticks".format(
+            p95 * 1000, p99 * 1000, len(times))
+        report("replay p50", label, p50, note)
+
+
+def free_cell(level, x, y):
+    """The first cell from x, y on to the right that does not block."""
+    while level.is_blocking(x, y):
+        x += 1
+    return x, y
+
+
+@benchmark
+def paths():
+    for size in (100, 1000):
+        level = load_map(size, size)
+        label = "{0}x{0}".format(size)
+        goal = [free_cell(level, size // 2, size // 2)]
+        report("FlowField", label, timeit(lambda: qq3.FlowField(level, goal), 1))
+        finder = qq3.Pathfinder(level)
+        finder.field(goal)
+        rng = numpy.random.RandomState(0)
+        cells = [(int(x), int(y)) for x, y in rng.randint(1, size - 1, (200, 2))]
+
+        def toggle():
+            for x, y in cells:
+                finder.set_blocking(x, y, not level.is_blocking(x, y))
+        report("Pathfinder.set_blocking", label, timeit(toggle) / len(cells))
+    # Walkers chasing the player: a search each against one shared field.
+    level = load_map(100, 100)
+    goal = [free_cell(level, 50, 50)]
+    starts = [(x, y) for x in range(1, 99) for y in range(1, 99)
+              if not level.is_blocking(x, y)][::25]
+    report("search per walker", "{0} walkers".format(len(starts)), timeit(
+        lambda: [qq3.FlowField(level, goal).direction(*pos)
+                 for pos in starts], 1))
+    report("shared flow field", "{0} walkers".format(len(starts)), timeit(
+        lambda: [field.direction(*pos) for field in
+                 [qq3.FlowField(level, goal)] for pos in starts]))
+    # Walkers chasing a player that moves a tile between searches, with
+    # the search bounded by CHASE_RANGE and over the whole map.
+    level = load_map(600, 600, walls=0.05, walkers=8 / 600 ** 2)
+    game = qq3.Game(level, headless=True)
+    x, y = free_cell(level, 300, 300)
+    cells = [(x + step, y) for step in range(20)
+             if not level.is_blocking(x + step, y)]
+    label = "{0} walkers".format(len(game.walkers))
+
+    def chase():
+        for pos in cells:
+            game.player.pos = pos
+            for walker in game.walkers:
+                walker.animation = None
+            game.steer()
+    for name, limit in (("chase per move", qq3.CHASE_RANGE),
+                        ("chase per move unbounded", None)):
+        chase_range, qq3.CHASE_RANGE = qq3.CHASE_RANGE, limit
+        try:
+            report(name, label, timeit(chase, 1) / len(cells))
+        finally:
+            qq3.CHASE_RANGE = chase_range
+    game = qq3.Game(load_map(200, 200, walkers=0.01), headless=True)
+    idle = HeldKeys()
+    report("Game.step", "{0} walkers".format(len(game.walkers)), timeit(
+        lambda: [game.step(idle) for _ in range(qq3.FPS)]) / qq3.FPS)
+
+
+def make_groups(game):
+    # The shadow, sprite and overlay groups the game drew before the
+    # render list.
+    groups = (pygame.sprite.RenderUpdates(), SortedUpdates(),
+              pygame.sprite.RenderUpdates())
+    # The groups held every sprite of the level, so the render list gets
+    # all of them too.
+    game.scenery.show(pygame.Rect((0, 0), game.background.get_size()))
+    game.scenery.limit = len(game.scenery.chunks)
+    entries = game.render_list.moving + [
+        (layer, order, sprite)
+        for sprite, (layer, depth, order) in game.render_list.still.items()]
+    for layer, order, sprite in sorted(entries, key=lambda entry: entry[1]):
+        groups[layer].add(sprite)
+    return groups
+
+
+def group_layers(game, groups, screen_rect):
+    # How draw_frame() went through the shadows, sprites and overlays
+    # before the render list: every sprite of each group, every frame.
+    offset = -game.camera.left, -game.camera.top
+    layers = []
+    for group, moves in zip(groups, (True, True, False)):
+        layer = []
+        for sprite in group.sprites():
+            if moves:
+                rect = sprite.shown_rect(game.alpha).move(offset)
+            else:
+                rect = sprite.rect.move(offset)
+            if rect.colliderect(screen_rect):
+                layer.append((sprite.image, rect))
+        layers.append(layer)
+    return layers
+
+
+@benchmark
+def layers():
+    # Thousands of bushes and crates that never move: what a tick costs to
+    # update them and to find what to draw, through the groups and through
+    # the render list, and the blits of a full redraw one at a time and
+    # batched.
+    screen = pygame.display.get_surface()
+    screen_rect = screen.get_rect()
+    for bushes, crates in ((0.05, 0.05), (0.15, 0.15)):
+        game = qq3.Game(load_map(200, 200, bushes=bushes, crates=crates))
+        game.draw_frame(1.0)
+        groups = make_groups(game)
+        label = "{0} sprites".format(len(game.level.items))
+        report("group updates", label, timeit(
+            lambda: (groups[1].update(), groups[0].update())))
+        report("mover updates", label, timeit(
+            lambda: ([sprite.update() for sprite in game.movers],
+                     [shadow.update() for shadow in game.mover_shadows])))
+        report("group layers", label,
+               timeit(lambda: group_layers(game, groups, screen_rect)))
+        report("render list gather", label,
+               timeit(lambda: game.render_list.gather(game.camera, game.alpha)))
+        shown = [(image, rect) for layer in group_layers(game, groups, screen_rect)
+                 for image, rect in layer]
+        report("blit each", "{0} blits".format(len(shown)),
+               timeit(lambda: [screen.blit(image, rect) for image, rect in shown]))
+        report("blits", "{0} blits".format(len(shown)),
+               timeit(lambda: screen.blits(shown, False)))
+        game.saves.close()
+
+
+@benchmark
+def frame():
+    # What a frame of Game.main does: a tick with the HUD, then drawing.
+    levels = [("level.map", qq3.Level())]
+    for size in (200, 1000):
+        levels.append(("{0}x{0}".format(size), load_map(size, size)))
+    ticks = 150
+    for label, level in levels:
+        game = qq3.Game(level)
+        game.needed = 10 ** 6
+        script = headless.random_script(ticks, 1)
+        times = []
+        pixels = []
+        for keys in script:
+            start = time.perf_counter()
+            game.hud.begin()
+            game.step(keys)
+            game.hud.show("potato", "P O T A T O  {0}".format(game.potato), (5, 210), (255, 255, 255))
+            game.hud.show("time", "T I M E  L E F T  {0}".format(game.deadline // qq3.FPS), (5, 230), (255, 255, 255))
+            game.draw_frame(1.0)
+            times.append(time.perf_counter() - start)
+            pixels.append(game.frame_pixels)
+        game.saves.close()
+        p50, p95, p99 = numpy.percentile(times, (50, 95, 99))
+        report("frame p50", label, p50, "p95 {0:.3f} ms, p99 {1:.3f} ms".format(
+            p95 * 1000, p99 * 1000))
+        # How much of the screen gets redrawn.
+        for p, value in zip((50, 95, 99), numpy.percentile(pixels, (50, 95, 99))):
+            report_count("frame pixels p{0}".format(p), label, float(value), "px")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark qq3.")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="benchmarks to run: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="show the change from the results in FILE")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark: " + ", ".join(unknown))
+    if args.compare:
+        BASELINE.update(load_results(args.compare))
+    pygame.init()
+    pygame.display.set_mode((qq3.MAP_TILE_WIDTH * 35, qq3.MAP_TILE_HEIGHT * 23))
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+    if args.save:
+        save_results(args.save)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
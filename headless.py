@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run qq3 without a window, one fixed game tick after another.
+
+A session is a script of the keys held on each tick. It is played with
+Game.step and no clock, so it runs as fast as the CPU allows:
+
+    import headless
+    headless.init()
+    level = qq3.Level()
+    result = headless.run_session(headless.expand([(8, [pg.K_UP])]),
+                                  level, potato=400, needed=500)
+
+Recordings of games, made with F5 or record_session(), are played back
+with replay(), which checks that every tick ends in the recorded state.
+"""
+
+import os
+import random
+import sys
+import time
+
+import pygame
+
+import qq3
+
+# The Game attributes a session can be started with.
+SETTINGS = ("potato", "needed", "deadline", "stoppedtime", "weightnum",
+            "maxcapacity", "forward_cost", "stop_cost", "backward_cost")
+# The ones a recording starts from, as they are part of the saved state.
+RECORDED_SETTINGS = ("potato", "needed", "deadline", "stoppedtime")
+
+
+class HeldKeys(object):
+    """Stands in for pygame.key.get_pressed() with some keys held down."""
+
+    def __init__(self, *keys):
+        self.keys = set(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+def init():
+    """Start pygame on the dummy video driver, with no window and no sound."""
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    # Leave SIGTERM alone, or worker processes can't be terminated.
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+    pygame.display.init()
+    # Sprite images are converted to the display format, so it needs a mode.
+    pygame.display.set_mode((1, 1))
+
+
+def expand(phases):
+    """Turn (ticks, keys) pairs into a script with the keys of every tick."""
+    script = []
+    for ticks, keys in phases:
+        script.extend([HeldKeys(*keys)] * ticks)
+    return script
+
+
+def run_session(script, level=None, max_ticks=None, **settings):
+    """Play script on a new headless Game and return how it ended.
+
+    The game runs for max_ticks ticks at most, by default as many as the
+    script has. Once the script runs out no keys are held.
+    """
+    game = qq3.Game(level, headless=True)
+    for name, value in settings.items():
+        if name not in SETTINGS:
+            raise ValueError("unknown setting {0!r}".format(name))
+        setattr(game, name, value)
+    if max_ticks is None:
+        max_ticks = len(script)
+    idle = HeldKeys()
+    ticks = 0
+    start = time.perf_counter()
+    while not game.game_over and ticks < max_ticks:
+        keys = script[ticks] if ticks < len(script) else idle
+        if game.is_game_paused:
+            # Like the pause screen, any key carries on.
+            if keys.keys:
+                game.is_game_paused = False
+        else:
+            game.step(keys)
+        ticks += 1
+    return {
+        "potato": game.potato,
+        "donation": game.donation,
+        "good_ending": game.good_ending,
+        "game_over": game.game_over,
+        "ticks": ticks,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def record_session(script, level=None, **settings):
+    """Play script on a new headless Game and return the recording."""
+    game = qq3.Game(level, headless=True)
+    for name, value in settings.items():
+        if name not in RECORDED_SETTINGS:
+            raise ValueError("{0!r} can't be recorded".format(name))
+        setattr(game, name, value)
+    game.recorder = qq3.Recorder(game)
+    for keys in script:
+        if game.game_over:
+            break
+        if game.is_game_paused:
+            game.is_game_paused = False
+        game.step(keys)
+    return game.recorder.finish()
+
+
+def replay(data, level=None, draw=False):
+    """Play a recording back and return the seconds each tick took.
+
+    Without level the map file the recording was made on is loaded. With
+    draw the game is drawn after every tick, which needs a display mode of
+    the size of the window, and the drawing is timed too. A tick that does
+    not end in the recorded state raises ValueError.
+    """
+    recording = qq3.Replay(data)
+    if level is None:
+        level = qq3.load_level(recording.level)
+    game = qq3.Game(level, headless=not draw)
+    game.load_state(recording.start)
+    times = []
+    clock = time.perf_counter
+    for tick, (keys, pressed_key) in enumerate(recording.ticks):
+        start = clock()
+        # Pausing does not take a tick, the recording goes on after it.
+        game.is_game_paused = False
+        game.pressed_key = pressed_key
+        if draw:
+            game.hud.begin()
+        game.step(keys)
+        if draw:
+            game.draw_frame(1.0)
+        times.append(clock() - start)
+        if game.state_hash() != recording.hashes[tick]:
+            raise ValueError("tick {0} does not match the recording".format(tick))
+    game.saves.close()
+    return times
+
+
+def random_script(ticks, seed=None):
+    """A script of random walks and presses of E, for testing balance."""
+    rng = random.Random(seed)
+    choices = [[pygame.K_UP], [pygame.K_DOWN], [pygame.K_LEFT],
+               [pygame.K_RIGHT], [pygame.K_UP, pygame.K_LSHIFT],
+               [pygame.K_e], [pygame.K_e], []]
+    phases = []
+    while sum(length for length, keys in phases) < ticks:
+        phases.append((rng.randint(1, 10), rng.choice(choices)))
+    return expand(phases)[:ticks]
+
+
+def main(argv):
+    sessions = int(argv[0]) if argv else 100
+    init()
+    level = qq3.Level()
+    start = time.perf_counter()
+    ticks = 0
+    for seed in range(sessions):
+        result = run_session(random_script(2000, seed), level,
+                             max_ticks=200 * qq3.FPS)
+        ticks += result["ticks"]
+    elapsed = time.perf_counter() - start
+    print("{0} sessions, {1} ticks in {2:.2f} s: {3:.0f} sessions/min, "
+          "{4:.0f} ticks/s".format(sessions, ticks, elapsed,
+                                   sessions * 60 / elapsed, ticks / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
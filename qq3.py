@@ -2,10 +2,26 @@
 # -*- coding: utf-8 -*-
 
 
+import bisect
+import collections
+import collections.abc
 import configparser
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
-import pickle
-
+import numpy
 import pygame
 import pygame.locals as pg
 
@@ -14,13 +30,115 @@ DY = [-1, 0, 1, 0]
 
 MAP_TILE_WIDTH, MAP_TILE_HEIGHT = 24, 16
 FPS = 15
+# The game logic runs at FPS ticks a second and is drawn at up to
+# RENDER_FPS frames, catching up at most MAX_CATCH_UP ticks in a frame.
+RENDER_FPS = 60
+MAX_CATCH_UP = 5
+
+# Bits of Level.flags, one byte per map cell.
+TILE_WALL = 1
+TILE_BLOCK = 2
+TILE_SPRITE = 4
+
+SOUNDS = ("music.wav", "rewind.wav", "stoptime.wav")
+SCREENS = ("start.png", "end.png", "win.png")
+# The map files played one after another, unless others are given.
+LEVELS = ("level.map",)
+# How many steps from the player a walker that chases it starts to.
+CHASE_RANGE = 40
+# How long the still screens sleep waiting for events, in milliseconds.
+IDLE_WAIT = 250
+
+# Fonts of the HUD, as (name, size) keys of FONT_CACHE.
+HUD_FONT = "Ugo", 20
+MESSAGE_FONT = "monospace", 16
+
+TRUE_VALUES = (True, 1, 'true', 'yes', 'True', 'Yes', '1', 'on', 'On')
+
+# Neighbour bits of a wall cell, used by Level.autotile.
+NEAR_S, NEAR_E, NEAR_W, NEAR_SE, NEAR_SW, NEAR_N = 1, 2, 4, 8, 16, 32
+
+SAVE_FILE = "save.dat"
+SAVE_MAGIC = b"QQ3S"
+SAVE_VERSION = 5
+# Magic and version, then SAVE_STATE: the Level.digest of the level,
+# potato, donation, needed, deadline, stopped time, whether time is
+# stopped, whether the player is weighed down and the numbers of sprites
+# and bushes. Then, as int32, the tile position of every sprite that walks
+# or animates, see Game.movers, and the tile position and time left of
+# every bush that is planted or ready, by rows.
+SAVE_HEADER = struct.Struct("<4sH")
+SAVE_STATE = struct.Struct("<20siiiiiBBII")
+# How many states Game.snapshot() keeps in memory.
+SNAPSHOTS = 8
+
+# Compiled levels, kept in LEVEL_CACHE_DIR next to the map under its name
+# and the hash of its text. Writing one removes those of older versions of
+# the same map. Magic, version, width, height and the size of the JSON with
+# the tileset, key, tile table and map rows, padded to 8 bytes. Then the
+# flags and tile ids, a byte per cell, and the autotile() tiles and
+# overlays, an int16 per cell.
+LEVEL_CACHE_DIR = ".levelcache"
+LEVEL_MAGIC = b"QQ3L"
+LEVEL_VERSION = 1
+LEVEL_HEADER = struct.Struct("<4sHIII")
 
+# Streamed levels, for maps too big to parse and keep whole. Magic,
+# version, width, height, chunk size, the size of the JSON with the
+# tileset, key and the characters of the map, whose codes are 1 up, 0
+# being a cell with no tile, and the SHA-1 of the file as written with
+# zeros in its place. Then chunk size squares of cell codes, a byte per
+# cell by rows, each followed by the (x, y) in it of its items as uint16
+# pairs. The file ends with a STREAM_CHUNK per chunk, by rows: where its
+# codes are, or 0 when all are the fill code, and where its items are.
+STREAM_MAGIC = b"QQ3M"
+STREAM_VERSION = 2
+STREAM_HEADER = struct.Struct("<4sHIIHI20s")
+STREAM_CHUNK = numpy.dtype([("data", "<u8"), ("items", "<u8"),
+                            ("count", "<u4"), ("fill", "u1")])
+STREAM_CHUNK_SIZE = 64
 
-last_save = []
+# Recorded input. Magic, version, the size of the save_state() the game
+# started from, the number of ticks and the size of the name of the map
+# file it was played on, then that name and that state. Then the keys of
+# the ticks as runs of (ticks, held keys, pressed key), the held keys as
+# bits and the pressed key as 1 + its index, both in CONTROL_KEYS. Then
+# the state_hash() after every tick, as uint32.
+REPLAY_FILE = "session.replay"
+REPLAY_MAGIC = b"QQ3R"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sHIIH")
+REPLAY_RUN = struct.Struct("<HHB")
+# The keys Game.control() looks at.
+CONTROL_KEYS = (pg.K_UP, pg.K_DOWN, pg.K_LEFT, pg.K_RIGHT, pg.K_LSHIFT,
+                pg.K_e, pg.K_p, pg.K_o, pg.K_i)
+
+
+def load_image(filename):
+    """Load an image converted to the display format, for fast blits.
+
+    Images with an alpha channel keep it, colour keyed ones get their key
+    with run-length acceleration.
+    """
+    image = pygame.image.load(filename)
+    if image.get_flags() & pygame.SRCALPHA:
+        return image.convert_alpha()
+    colorkey = image.get_colorkey()
+    image = image.convert()
+    if colorkey is not None:
+        image.set_colorkey(colorkey, pygame.RLEACCEL)
+    return image
 
 
 class TileCache(object):
-    
+    """Tile tables of images, as lists of columns of subsurfaces.
+
+    pack() loads several images into one atlas surface, so all their tiles
+    share a surface and a pixel format. The atlas is colour keyed unless
+    one of the images is partly see-through.
+    Variants of a tile table, like a see-through one from with_alpha(),
+    are separate surfaces cached next to it.
+    """
     
     def __init__(self,  width=32, height=None):
         self.width = width
@@ -39,37 +157,331 @@ class TileCache(object):
             return tile_table
 
     def _load_tile_table(self, filename, width, height):
-        image = pygame.image.load(filename).convert()
-        image_width, image_height = image.get_size()
+        return self._slice(load_image(filename), (0, 0), width, height)
+
+    def _slice(self, image, offset, width, height, size=None):
+        image_width, image_height = size or image.get_size()
         tile_table = []
         for tile_x in range(0, image_width // width):
             line = []
             tile_table.append(line)
             for tile_y in range(0, image_height // height):
-                rect = (tile_x*width, tile_y*height, width, height)
+                rect = (offset[0] + tile_x*width, offset[1] + tile_y*height,
+                        width, height)
                 line.append(image.subsurface(rect))
         return tile_table
 
+    def pack(self, filenames, atlas_width=1024):
+        """Load the images that are not cached yet into one atlas.
+
+        Images that are only ever fully opaque or fully clear share a
+        colour key, which blits faster than blending. Any partly clear
+        pixel makes an atlas with an alpha channel instead.
+        """
+        images = []
+        for filename in sorted(set(filenames)):
+            if (filename, self.width, self.height) not in self.cache:
+                images.append((filename, pygame.image.load(filename).convert_alpha()))
+        if not images:
+            return None
+        # Shelves of images, tallest first, each as wide as the atlas.
+        images.sort(key=lambda item: -item[1].get_height())
+        atlas_width = max([atlas_width] + [image.get_width() for _, image in images])
+        places = []
+        x = y = shelf = 0
+        for filename, image in images:
+            width, height = image.get_size()
+            if x + width > atlas_width:
+                x, y, shelf = 0, y + shelf, 0
+            places.append((x, y))
+            x += width
+            shelf = max(shelf, height)
+        size = atlas_width, y + shelf
+
+        colours = []
+        translucent = False
+        for filename, image in images:
+            alpha = pygame.surfarray.array_alpha(image)
+            translucent = translucent or bool(((alpha > 0) & (alpha < 255)).any())
+            rgb = pygame.surfarray.array3d(image)[alpha > 0].astype(numpy.uint32)
+            colours.append(rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2])
+        if translucent:
+            atlas = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+            atlas.fill((0, 0, 0, 0))
+            flags = pygame.BLEND_RGBA_MAX
+        else:
+            # The first colour from magenta down that no image uses.
+            used = numpy.unique(numpy.concatenate(colours))
+            key = 0xFF00FF
+            while key in used:
+                key -= 1
+            colorkey = key >> 16, key >> 8 & 255, key & 255
+            atlas = pygame.Surface(size).convert()
+            atlas.fill(colorkey)
+            atlas.set_colorkey(colorkey)
+            flags = 0
+        for (filename, image), place in zip(images, places):
+            # Clear pixels leave the colour key or transparent black.
+            atlas.blit(image, place, special_flags=flags)
+            self.cache[(filename, self.width, self.height)] = self._slice(
+                atlas, place, self.width, self.height, image.get_size())
+        return atlas
+
+    def with_alpha(self, filename, alpha):
+        """The tile table of filename, with its opacity scaled by alpha/255."""
+        key = (filename, self.width, self.height, alpha)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        tile_table = []
+        for line in self[filename]:
+            faded = []
+            for tile in line:
+                tile = tile.copy()
+                if tile.get_flags() & pygame.SRCALPHA:
+                    tile.fill((255, 255, 255, alpha), special_flags=pygame.BLEND_RGBA_MULT)
+                else:
+                    tile.set_alpha(alpha, pygame.RLEACCEL)
+                faded.append(tile)
+            tile_table.append(faded)
+        self.cache[key] = tile_table
+        return tile_table
+
+
+class FontCache(object):
+    """Fonts by (name, size), each created once with SysFont."""
+
+    def __init__(self):
+        self.cache = {}
+
+    def __getitem__(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            name, size = key
+            font = pygame.font.SysFont(name, size)
+            self.cache[key] = font
+            return font
+
+
+class TextCache(object):
+    """Rendered text surfaces, keeping only the most recently used ones."""
+
+    def __init__(self, fonts, size=256):
+        self.fonts = fonts
+        self.size = size
+        self.cache = collections.OrderedDict()
+
+    def render(self, font, text, colour):
+        key = font, text, colour
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:
+            image = self.fonts[font].render(text, 1, colour)
+            self.cache[key] = image
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            return image
+
+
+class SoundBank(object):
+    """Sounds decoded once up front and played on a fixed set of channels.
+
+    Channel 0 is kept for the music, the others take turns playing
+    effects. With background=True the files are decoded on a thread, and
+    sounds asked for before they are ready are skipped, never waited for.
+    load_time is how long decoding took, in seconds, shown with F3. Files that are not
+    there, or a mixer that could not start, make for silence.
+    """
+
+    def __init__(self, filenames, channels=4, background=False):
+        self.filenames = filenames
+        self.sounds = {}
+        self.missing = []
+        self.load_time = None
+        self.channels = []
+        self.next_channel = 1
+        self.music = None
+        self.lock = threading.Lock()
+        if not pygame.mixer.get_init():
+            return
+        pygame.mixer.set_num_channels(max(channels, pygame.mixer.get_num_channels()))
+        pygame.mixer.set_reserved(1)
+        self.channels = [pygame.mixer.Channel(i) for i in range(channels)]
+        if background:
+            threading.Thread(target=self.load, daemon=True).start()
+        else:
+            self.load()
+
+    def load(self):
+        start = time.perf_counter()
+        for filename in self.filenames:
+            if not os.path.exists(filename):
+                self.missing.append(filename)
+                continue
+            self.sounds[filename] = pygame.mixer.Sound(filename)
+        with self.lock:
+            self.load_time = time.perf_counter() - start
+            # play_music() takes the lock, so music asked for while
+            # loading is started here.
+            if self.music is not None:
+                filename, loops = self.music
+                self.music = None
+                sound = self.sounds.get(filename)
+                if sound is not None:
+                    self.channels[0].play(sound, loops)
+
+    def play(self, filename):
+        """Play an effect on an idle channel, or the one used longest ago."""
+        sound = self.sounds.get(filename)
+        if sound is None or len(self.channels) < 2:
+            return
+        for channel in self.channels[1:]:
+            if not channel.get_busy():
+                break
+        else:
+            channel = self.channels[self.next_channel]
+            self.next_channel = self.next_channel % (len(self.channels) - 1) + 1
+        channel.play(sound)
+
+    def play_music(self, filename, loops=0):
+        """Play music on channel 0, as soon as it is loaded."""
+        with self.lock:
+            sound = self.sounds.get(filename)
+            if self.load_time is None:
+                self.music = filename, loops
+            elif sound is not None:
+                self.music = None
+                self.channels[0].play(sound, loops)
+
+
+class RenderList(object):
+    """The shadows, sprites and overlays of a level in the order they are
+    drawn: shadows, then sprites by depth, then overlays.
+
+    Entries that stay put are filed by position in square cells of
+    cell_size pixels, each kept in drawing order as entries are added.
+    The cells under the camera are merged into one list, kept until the
+    camera moves onto other cells or an entry is added or removed, so a
+    frame only goes through that list in order. Entries that move are
+    looked at on every gather() and put in their places with bisect.
+    """
+
+    SHADOWS, SPRITES, OVERLAYS = range(3)
+
+    def __init__(self, cell_size=256):
+        self.cell_size = cell_size
+        # The sort keys and entries of each cell, in drawing order.
+        self.cells = {}
+        # The sort key of every entry that stays put.
+        self.still = {}
+        self.moving = []
+        self.count = 0
+        # How far an entry reaches past the cell its top left corner is in.
+        self.reach = 0
+        # The cells and still entries the merged list was made from, and
+        # (key, sprite) of its entries in drawing order.
+        self.merged_from = None
+        self.merged = []
+
+    def add(self, sprite, layer, moves=False, order=None):
+        """Add a sprite with an image and a rect, one that moves has
+        shown_rect() and one that stays put on the sprite layer depth.
+
+        Sprites that move are drawn at the depth of the bottom of where
+        they are shown, so the order only changes when what is shown moves.
+        Entries of a layer at the same depth are drawn by order, the order
+        they were added in without it.
+        """
+        self.count += 1
+        if order is None:
+            order = self.count
+        if moves:
+            self.moving.append((layer, order, sprite))
+        else:
+            depth = sprite.depth if layer == self.SPRITES else 0
+            key = layer, depth, order
+            self.still[sprite] = key
+            keys, sprites = self.cells.setdefault(self._cell(sprite.rect), ([], []))
+            index = bisect.bisect_right(keys, key)
+            keys.insert(index, key)
+            sprites.insert(index, sprite)
+            self.reach = max(self.reach, sprite.rect.width, sprite.rect.height)
+            self.merged_from = None
+
+    def remove(self, sprite):
+        """Take out an entry that stays put."""
+        key = self.still.pop(sprite)
+        cell = self._cell(sprite.rect)
+        keys, sprites = self.cells[cell]
+        index = bisect.bisect_left(keys, key)
+        while sprites[index] is not sprite:
+            index += 1
+        del keys[index]
+        del sprites[index]
+        if not keys:
+            del self.cells[cell]
+        self.merged_from = None
+
+    def _cell(self, rect):
+        return rect.x // self.cell_size, rect.y // self.cell_size
 
-class SortedUpdates(pygame.sprite.RenderUpdates):
-    def sprites(self):
-        return sorted(list(self.spritedict.keys()), key=lambda sprite: sprite.depth)
+    def gather(self, view, alpha=1.0):
+        """Return (sprite, image, rect) for every entry that overlaps view,
+        in drawing order. rect is where it is shown, alpha of the way from
+        where it was a tick ago for entries that move."""
+        size = self.cell_size
+        columns = range((view.left - self.reach) // size, (view.right - 1) // size + 1)
+        rows = range((view.top - self.reach) // size, (view.bottom - 1) // size + 1)
+        if self.merged_from != (columns, rows):
+            cells = [zip(*self.cells[cx, cy]) for cy in rows for cx in columns
+                     if (cx, cy) in self.cells]
+            self.merged = list(heapq.merge(*cells, key=_entry_key))
+            self.merged_from = columns, rows
+        found = [(key, sprite, sprite.image, sprite.rect)
+                 for key, sprite in self.merged if sprite.rect.colliderect(view)]
+        moving = []
+        for layer, order, sprite in self.moving:
+            rect = sprite.shown_rect(alpha)
+            if rect.colliderect(view):
+                depth = rect.bottom if layer == self.SPRITES else 0
+                moving.append(((layer, depth, order), sprite, sprite.image, rect))
+        if moving:
+            # Last first, so the places of the ones before stay right.
+            keys = [entry[0] for entry in found]
+            moving.sort(key=_entry_key, reverse=True)
+            for entry in moving:
+                found.insert(bisect.bisect_right(keys, entry[0]), entry)
+        return [entry[1:] for entry in found]
+
+
+def _entry_key(entry):
+    return entry[0]
 
 
 class Shadow(pygame.sprite.Sprite):
     def __init__(self, owner):
         pygame.sprite.Sprite.__init__(self)
-        self.image = SPRITE_CACHE["shadow.png"][0][0]
-        self.image.set_alpha(64)
+        self.image = SPRITE_CACHE.with_alpha("shadow.png", 64)[0][0]
         self.rect = self.image.get_rect()
         self.owner = owner
+        self.update()
 
     def update(self, *args):
         self.rect.midbottom = self.owner.rect.midbottom
 
+    def shown_rect(self, alpha=1.0):
+        shown = self.owner.shown_rect(alpha)
+        return self.rect.move(shown.x - self.owner.rect.x,
+                              shown.y - self.owner.rect.y)
+
 
 class Sprite(pygame.sprite.Sprite):
     is_player = False
+    # Where the sprite was before it moved in the current tick.
+    origin = None
 
     def __init__(self, pos=(0, 0), frames=None):
         super(Sprite, self).__init__()
@@ -91,9 +503,24 @@ class Sprite(pygame.sprite.Sprite):
     pos = property(_get_pos, _set_pos)
 
     def move(self, dx, dy):
+        if self.origin is None:
+            self.origin = self.rect.topleft
         self.rect.move_ip(dx, dy)
         self.depth = self.rect.midbottom[1]
 
+    def shown_rect(self, alpha=1.0):
+        """Where to draw the sprite, alpha of the way from origin to rect.
+
+        This is self.rect itself when the sprite did not move, so it must
+        not be changed.
+        """
+        if self.origin is None or alpha >= 1:
+            return self.rect
+        x, y = self.origin
+        back = 1 - alpha
+        return self.rect.move(round((x - self.rect.x) * back),
+                              round((y - self.rect.y) * back))
+
     def stand_animation(self):
         while True:
             for frame in self.frames[0]:
@@ -132,21 +559,80 @@ class Player(Sprite):
             except StopIteration:
                 self.animation = None
 
+
+class Walker(Sprite):
+    """A sprite that walks a tile at a time, where Game.steer() sends it.
+
+    goal is what it heads for, "player" or the name of a feature. One
+    that heads for the player waits until it is within CHASE_RANGE steps.
+    """
+
+    def __init__(self, pos, frames, goal):
+        Sprite.__init__(self, pos, frames)
+        self.goal = goal
+        self.animation = None
+
+    def walk_animation(self, d):
+        for frame in range(4):
+            self.image = self.frames[0][frame]
+            yield None
+            self.move(3*DX[d], 2*DY[d])
+            yield None
+            self.move(3*DX[d], 2*DY[d])
+
+    def update(self, *args):
+        if self.animation is not None:
+            try:
+                next(self.animation)
+            except StopIteration:
+                self.animation = None
+
+
 class Level(object):
     
     
-    def __init__(self, filename="level.map"):
+    def __init__(self, filename="level.map", cache=True):
+        self.filename = filename
         self.tileset = ''
         self.map = []
         self.items = {}
         self.key = {}
         self.width = 0
         self.height = 0
-        self.load_file(filename)
+        self.flags = bytearray()
+        self.tile_ids = bytearray()
+        self.tile_table = []
+        self._autotile = None
+        # The SHA-1 of the map file, which saved games are checked against.
+        self.digest = b''
+        self.load_file(filename, cache)
 
-    def load_file(self, filename="level.map"):
+    def load_file(self, filename="level.map", cache=True):
+        """Load a map, from its compiled copy if there is a current one.
+
+        The first load of a map with cache on writes the compiled copy, so
+        later ones skip parsing and autotiling.
+        """
+        with open(filename, "rb") as f:
+            source = f.read()
+        self.digest = hashlib.sha1(source).digest()
+        path = None
+        if cache:
+            path = level_cache_path(filename, source)
+            if self._load_compiled(path):
+                return
+        self._parse(source.decode("utf-8"))
+        if path is not None:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_atomic(path, self.compile())
+                prune_level_cache(path)
+            except OSError:
+                pass
+
+    def _parse(self, text):
         parser = configparser.ConfigParser()
-        parser.read(filename)
+        parser.read_string(text)
         self.tileset = parser.get("level", "tileset")
         self.map = parser.get("level", "map").split("\n")
         for section in parser.sections():
@@ -155,18 +641,181 @@ class Level(object):
                 self.key[section] = desc
         self.width = len(self.map[0])
         self.height = len(self.map)
-        for y, line in enumerate(self.map):
-            for x, c in enumerate(line):
-                if not self.is_wall(x, y) and 'sprite' in self.key[c]:
-                    self.items[(x, y)] = self.key[c]
+        self._build_grid()
+        self._autotile = None
+        self._find_items()
+
+    def _find_items(self):
+        flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+        cells = numpy.flatnonzero((flags & (TILE_WALL | TILE_SPRITE)) == TILE_SPRITE)
+        for index in cells.tolist():
+            x, y = index % self.width, index // self.width
+            self.items[(x, y)] = self.key[self.map[y][x]]
+
+    def compile(self):
+        """Return the level as the bytes of a compiled level file."""
+        meta = json.dumps({"tileset": self.tileset, "key": self.key,
+                           "tile_table": self.tile_table,
+                           "map": self.map}).encode("utf-8")
+        meta += b"\0" * (-(LEVEL_HEADER.size + len(meta)) % 8)
+        tiles, overs = self.autotile()
+        return b"".join((
+            LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, self.width,
+                              self.height, len(meta)),
+            meta, bytes(self.flags), bytes(self.tile_ids),
+            tiles.astype("<i2").tobytes(), overs.astype("<i2").tobytes()))
+
+    def _load_compiled(self, path):
+        """Load a compiled level file, return False if it is not usable.
+
+        The file is mapped, not read, and the autotile() arrays are views
+        of the mapping, so only the parts that get used are paged in.
+        """
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, width, height, size = LEVEL_HEADER.unpack_from(data)
+            cells = width * height
+            offset = LEVEL_HEADER.size + size
+            if (magic != LEVEL_MAGIC or version != LEVEL_VERSION or
+                    len(data) != offset + 6 * cells):
+                return False
+            meta = json.loads(data[LEVEL_HEADER.size:offset].rstrip(b"\0").decode("utf-8"))
+            tileset = meta["tileset"]
+            key = meta["key"]
+            tile_table = [tuple(tile) for tile in meta["tile_table"]]
+            rows = meta["map"]
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            return False
+        self.tileset = tileset
+        self.key = key
+        self.tile_table = tile_table
+        self.map = rows
+        self.width = width
+        self.height = height
+        self.flags = bytearray(data[offset:offset + cells])
+        self.tile_ids = bytearray(data[offset + cells:offset + 2 * cells])
+        offset += 2 * cells
+        tiles = numpy.frombuffer(data, "<i2", cells, offset)
+        overs = numpy.frombuffer(data, "<i2", cells, offset + 2 * cells)
+        self._autotile = (tiles.reshape(height, width),
+                          overs.reshape(height, width))
+        self._find_items()
+        return True
+
+    def _build_grid(self):
+        """Precompute the flag and tile index of every cell."""
+        self.tile_table, cell_flags, cell_tiles = _key_tables(self.key)
+        text = ''.join(line[:self.width].ljust(self.width, '\0')
+                       for line in self.map)
+        chars = set(text)
+        flag_table = {ord(c): cell_flags.get(c, 0) for c in chars}
+        tile_table = {ord(c): cell_tiles.get(c, 0) for c in chars}
+        self.flags = bytearray(text.translate(flag_table).encode('latin-1'))
+        self.tile_ids = bytearray(text.translate(tile_table).encode('latin-1'))
+
+    def _index(self, x, y):
+        # Negative coordinates wrap around like indexing self.map does.
+        if not -self.width <= x < self.width:
+            return -1
+        if not -self.height <= y < self.height:
+            return -1
+        return (y % self.height) * self.width + x % self.width
+
+    def cells(self, x, y, width, height):
+        """Return the flags and tile ids of a rectangle of the map as 2D
+        arrays, the rectangle must be inside the map."""
+        flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+        tile_ids = numpy.frombuffer(self.tile_ids, dtype=numpy.uint8)
+        flags = flags.reshape(self.height, self.width)
+        tile_ids = tile_ids.reshape(self.height, self.width)
+        return (flags[y:y+height, x:x+width],
+                tile_ids[y:y+height, x:x+width])
+
+    def _window(self, x, y, width, height):
+        """Return the walls of a rectangle and of a cell around it, as
+        is_wall sees them, and the tile ids of the rectangle."""
+        walls = numpy.zeros((height + 2, width + 2), dtype=bool)
+        for top, rows in _spans(y - 1, height + 2, self.height):
+            for left, columns in _spans(x - 1, width + 2, self.width):
+                flags = self.cells(columns.start, rows.start,
+                                   len(columns), len(rows))[0]
+                walls[top:top+len(rows), left:left+len(columns)] = flags & TILE_WALL
+        return walls, self.cells(x, y, width, height)[1]
+
+    def autotile(self):
+        """Return the tile and overlay code of every cell as 2D arrays.
+
+        A code is tile_x * 16 + tile_y, overlays are -1 where there is none.
+        """
+        if self._autotile is None:
+            self._autotile = self.autotile_region(0, 0, self.width, self.height)
+        return self._autotile
+
+    def autotile_region(self, x, y, width, height):
+        """Return the tile and overlay codes of a rectangle of the map."""
+        if self._autotile is not None:
+            tiles, overs = self._autotile
+            return (tiles[y:y+height, x:x+width],
+                    overs[y:y+height, x:x+width])
+        walls, tile_ids = self._window(x, y, width, height)
+        return _autotile(walls, tile_ids, self.tile_table)
+
+    def render_region(self, x, y, width, height):
+        """Render a rectangle of the map, in tiles, with batched blits."""
+        tiles, overs = self.autotile_region(x, y, width, height)
+        table = MAP_CACHE[self.tileset]
+        surfaces = {}
+        for code in numpy.unique(tiles).tolist():
+            surfaces[code] = table[code // 16][code % 16]
+        image = pygame.Surface((width*MAP_TILE_WIDTH, height*MAP_TILE_HEIGHT))
+        blits = []
+        for row, codes in enumerate(tiles.tolist()):
+            top = row * MAP_TILE_HEIGHT
+            blits.extend([(surfaces[code], (column*MAP_TILE_WIDTH, top))
+                          for column, code in enumerate(codes)])
+        image.blits(blits, False)
+        return image
+
+    def render_overlays(self, x=0, y=0, width=None, height=None):
+        """Return the overlay tiles of a rectangle of the map by position."""
+        if width is None:
+            width = self.width - x
+        if height is None:
+            height = self.height - y
+        tiles, overs = self.autotile_region(x, y, width, height)
+        table = MAP_CACHE[self.tileset]
+        overlays = {}
+        rows, columns = numpy.nonzero(overs >= 0)
+        codes = overs[rows, columns].tolist()
+        for map_y, map_x, code in zip((rows + y).tolist(),
+                                      (columns + x).tolist(), codes):
+            overlays[(map_x, map_y)] = table[code // 16][code % 16]
+        return overlays
+
+    def items_in(self, x, y, width, height):
+        """Return the items of a rectangle of the map by position."""
+        items = self.items
+        found = {}
+        for map_y in range(y, y + height):
+            for map_x in range(x, x + width):
+                item = items.get((map_x, map_y))
+                if item is not None:
+                    found[(map_x, map_y)] = item
+        return found
+
+    def render_vectorized(self):
+        """Same result as render(), computed with autotile()."""
+        image = self.render_region(0, 0, self.width, self.height)
+        return image, self.render_overlays()
 
     def render(self):
         wall = self.is_wall
         tiles = MAP_CACHE[self.tileset]
         image = pygame.Surface((self.width*MAP_TILE_WIDTH, self.height*MAP_TILE_HEIGHT))
         overlays = {}
-        for map_y, line in enumerate(self.map):
-            for map_x, c in enumerate(line):
+        for map_y in range(self.height):
+            for map_x in range(self.width):
                 if wall(map_x, map_y):
                     if not wall(map_x, map_y+1):
                         if wall(map_x+1, map_y) and wall(map_x-1, map_y):
@@ -197,11 +846,7 @@ class Level(object):
                             over = 3, 0
                         overlays[(map_x, map_y)] = tiles[over[0]][over[1]]
                 else:
-                    try:
-                        tile = self.key[c]['tile'].split(',')
-                        tile = int(tile[0]), int(tile[1])
-                    except (ValueError, KeyError):
-                        tile = 0, 3
+                    tile = self.tile_table[self.tile_ids[map_y*self.width + map_x]]
                 tile_image = tiles[tile[0]][tile[1]]
                 image.blit(tile_image,
                            (map_x*MAP_TILE_WIDTH, map_y*MAP_TILE_HEIGHT))
@@ -220,38 +865,1507 @@ class Level(object):
 
     def get_bool(self, x, y, name):
         value = self.get_tile(x, y).get(name)
-        return value in (True, 1, 'true', 'yes', 'True', 'Yes', '1', 'on', 'On')
+        return value in TRUE_VALUES
 
     def is_wall(self, x, y):
-        return self.get_bool(x, y, 'wall')
+        index = self._index(x, y)
+        return index >= 0 and self.flags[index] & TILE_WALL != 0
 
     def is_blocking(self, x, y):
         if not 0 <= x < self.width or not 0 <= y < self.height:
             return True
-        return self.get_bool(x, y, 'block')
+        return self.flags[y*self.width + x] & TILE_BLOCK != 0
+
+    def set_blocking(self, x, y, blocking):
+        index = y*self.width + x
+        if blocking:
+            self.flags[index] |= TILE_BLOCK
+        else:
+            self.flags[index] &= ~TILE_BLOCK & 0xFF
+
+    def row_flags(self, y, flag, x=0, width=None):
+        """Return a bytearray with 1 for each cell of row y that has flag set.
+
+        The row is clipped to the map, cells outside it are not returned.
+        """
+        if not 0 <= y < self.height:
+            return b''
+        if width is None:
+            width = self.width - x
+        start = max(x, 0)
+        end = min(x + width, self.width)
+        if end <= start:
+            return b''
+        row = y * self.width
+        return self.flags[row + start:row + end].translate(_flag_table(flag))
+
+    def count_flags(self, flag, x=0, y=0, width=None, height=None):
+        """Count the cells of a rectangle that have any bit of flag set."""
+        if height is None:
+            height = self.height - y
+        total = 0
+        for row in range(max(y, 0), min(y + height, self.height)):
+            total += self.row_flags(row, flag, x, width).count(1)
+        return total
+
+    def any_flags(self, flag, x=0, y=0, width=None, height=None):
+        """Check if any cell of a rectangle has any bit of flag set."""
+        if height is None:
+            height = self.height - y
+        for row in range(max(y, 0), min(y + height, self.height)):
+            if 1 in self.row_flags(row, flag, x, width):
+                return True
+        return False
+
+
+class StreamedLevel(Level):
+    """A level read from a map in the chunked format of write_streamed().
+
+    The file is mapped and its chunks are only looked at when a cell in
+    them is, so memory grows with the part of the map that gets used
+    rather than with its size. Chunks whose cells are all the same take
+    no room in the file. set_blocking() keeps its changes aside, the file
+    is never written to.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.width, self.height, self.chunk_size,
+         size, self.digest) = STREAM_HEADER.unpack_from(self.data)
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise ValueError("%s is not a streamed level" % filename)
+        meta = self.data[STREAM_HEADER.size:STREAM_HEADER.size + size]
+        meta = json.loads(meta.decode("utf-8"))
+        self.tileset = meta["tileset"]
+        self.key = meta["key"]
+        self.chars = [''] + meta["chars"]
+        self.tile_table, cell_flags, cell_tiles = _key_tables(self.key)
+        self.code_flags = numpy.array(
+            [cell_flags.get(char, 0) for char in self.chars], dtype=numpy.uint8)
+        self.code_tiles = numpy.array(
+            [cell_tiles.get(char, 0) for char in self.chars], dtype=numpy.uint8)
+        self.columns = -(-self.width // self.chunk_size)
+        self.rows = -(-self.height // self.chunk_size)
+        count = self.columns * self.rows
+        self.directory = numpy.frombuffer(
+            self.data, STREAM_CHUNK, count,
+            len(self.data) - count * STREAM_CHUNK.itemsize)
+        self.chunks = {}
+        self.fills = {}
+        # set_blocking() flags by chunk, then by position.
+        self.changed = {}
+        self.flags = StreamedFlags(self)
+        self.items = StreamedItems(self)
+        self._autotile = None
+
+    def chunk(self, cx, cy):
+        """Return the cell codes of a chunk as a square array."""
+        try:
+            return self.chunks[cx, cy]
+        except KeyError:
+            pass
+        entry = self.directory[cy * self.columns + cx]
+        size = self.chunk_size
+        if entry["data"]:
+            codes = numpy.frombuffer(self.data, numpy.uint8, size * size,
+                                     int(entry["data"])).reshape(size, size)
+        else:
+            fill = int(entry["fill"])
+            codes = self.fills.get(fill)
+            if codes is None:
+                codes = numpy.full((size, size), fill, dtype=numpy.uint8)
+                self.fills[fill] = codes
+        # Only views of the mapping are kept, the pages are the system's.
+        self.chunks[cx, cy] = codes
+        return codes
+
+    def code(self, x, y):
+        size = self.chunk_size
+        return int(self.chunk(x // size, y // size)[y % size, x % size])
+
+    def cells(self, x, y, width, height):
+        size = self.chunk_size
+        codes = numpy.zeros((height, width), dtype=numpy.uint8)
+        if width <= 0 or height <= 0:
+            return codes, codes
+        for cy in range(y // size, (y + height - 1) // size + 1):
+            top = max(y, cy * size)
+            bottom = min(y + height, cy * size + size)
+            for cx in range(x // size, (x + width - 1) // size + 1):
+                left = max(x, cx * size)
+                right = min(x + width, cx * size + size)
+                codes[top-y:bottom-y, left-x:right-x] = self.chunk(cx, cy)[
+                    top-cy*size:bottom-cy*size, left-cx*size:right-cx*size]
+        flags = self.code_flags[codes]
+        for (cx, cy), changed in self.changed.items():
+            if (cx * size < x + width and x < cx * size + size and
+                    cy * size < y + height and y < cy * size + size):
+                for (cell_x, cell_y), value in changed.items():
+                    if x <= cell_x < x + width and y <= cell_y < y + height:
+                        flags[cell_y - y, cell_x - x] = value
+        return flags, self.code_tiles[codes]
+
+    def autotile(self):
+        # The whole map at once is what this class is meant to avoid, so
+        # it is not kept.
+        return self.autotile_region(0, 0, self.width, self.height)
+
+    def render_overlays(self, x=0, y=0, width=None, height=None):
+        if width is None:
+            width = self.width - x
+        if height is None:
+            height = self.height - y
+        overlays = {}
+        for top in range(y, y + height, self.chunk_size):
+            overlays.update(Level.render_overlays(
+                self, x, top, width, min(self.chunk_size, y + height - top)))
+        return overlays
+
+    def render_vectorized(self):
+        image = self.render_region(0, 0, self.width, self.height)
+        return image, self.render_overlays()
+
+    render = render_vectorized
+
+    def get_tile(self, x, y):
+        if not -self.width <= x < self.width:
+            return {}
+        if not -self.height <= y < self.height:
+            return {}
+        char = self.chars[self.code(x % self.width, y % self.height)]
+        return self.key.get(char, {})
+
+    def row_flags(self, y, flag, x=0, width=None):
+        if not 0 <= y < self.height:
+            return b''
+        if width is None:
+            width = self.width - x
+        start = max(x, 0)
+        end = min(x + width, self.width)
+        if end <= start:
+            return b''
+        flags = self.cells(start, y, end - start, 1)[0][0]
+        return bytearray(((flags & flag) != 0).astype(numpy.uint8).tobytes())
+
+
+class StreamedFlags(object):
+    """The flags of a StreamedLevel, indexed like Level.flags."""
+
+    def __init__(self, level):
+        self.level = level
+
+    def __len__(self):
+        return self.level.width * self.level.height
+
+    def __getitem__(self, index):
+        level = self.level
+        y, x = divmod(index % len(self), level.width)
+        size = level.chunk_size
+        changed = level.changed.get((x // size, y // size))
+        if changed is not None and (x, y) in changed:
+            return changed[(x, y)]
+        return int(level.code_flags[level.code(x, y)])
+
+    def __setitem__(self, index, value):
+        level = self.level
+        y, x = divmod(index % len(self), level.width)
+        size = level.chunk_size
+        level.changed.setdefault((x // size, y // size), {})[(x, y)] = value
+
+
+class StreamedItems(collections.abc.Mapping):
+    """The items of a StreamedLevel by position, read a chunk at a time.
+
+    Looking a position up keeps the items of its chunk, going through all
+    of them reads the chunks in turn without keeping them.
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.chunks = {}
+        self.count = int(level.directory["count"].sum())
+
+    def read(self, cx, cy):
+        level = self.level
+        entry = level.directory[cy * level.columns + cx]
+        count = int(entry["count"])
+        items = {}
+        if not count:
+            return items
+        codes = level.chunk(cx, cy)
+        cells = numpy.frombuffer(level.data, "<u2", 2 * count, int(entry["items"]))
+        left = cx * level.chunk_size
+        top = cy * level.chunk_size
+        for x, y in cells.reshape(count, 2).tolist():
+            items[(left + x, top + y)] = level.key[level.chars[codes[y, x]]]
+        return items
+
+    def __getitem__(self, pos):
+        x, y = pos
+        level = self.level
+        if not (0 <= x < level.width and 0 <= y < level.height):
+            raise KeyError(pos)
+        key = x // level.chunk_size, y // level.chunk_size
+        try:
+            items = self.chunks[key]
+        except KeyError:
+            items = self.chunks[key] = self.read(*key)
+        return items[pos]
+
+    def __iter__(self):
+        for pos, item in self.items():
+            yield pos
+
+    def items(self):
+        # By rows like Level.items, so sprites are made in the same order
+        # and saved games work with either. The items of a band of chunks
+        # are only kept while it is gone through.
+        level = self.level
+        counts = level.directory["count"].reshape(level.rows, level.columns)
+        for cy, row in enumerate(counts):
+            band = {}
+            for cx in numpy.flatnonzero(row).tolist():
+                band.update(self.read(cx, cy))
+            for pos in sorted(band, key=lambda pos: (pos[1], pos[0])):
+                yield pos, band[pos]
+
+    def __len__(self):
+        return self.count
+
+
+def write_streamed(filename, width, height, tileset, key, rows,
+                   chunk_size=STREAM_CHUNK_SIZE):
+    """Write a map in the format StreamedLevel reads.
+
+    rows(y, count) returns count rows of the map from row y as strings,
+    like the lines of a map file. They are asked for a band of chunks at
+    a time, so the map is never in memory whole.
+    """
+    chars = list(key)
+    if len(chars) > 255:
+        raise ValueError("a streamed level has at most 255 kinds of tile")
+    tile_table, cell_flags, cell_tiles = _key_tables(key)
+    codes = dict((ord(char), i + 1) for i, char in enumerate(chars))
+    is_item = numpy.zeros(256, dtype=bool)
+    for i, char in enumerate(chars):
+        is_item[i + 1] = cell_flags[char] & (TILE_WALL | TILE_SPRITE) == TILE_SPRITE
+    columns = -(-width // chunk_size)
+    directory = numpy.zeros((-(-height // chunk_size), columns), STREAM_CHUNK)
+
+    def pieces():
+        meta = json.dumps({"tileset": tileset, "key": key,
+                           "chars": chars}).encode("utf-8")
+        yield STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, width, height,
+                                 chunk_size, len(meta), bytes(20))
+        offset = STREAM_HEADER.size + len(meta)
+        yield meta
+        band = numpy.zeros((chunk_size, columns * chunk_size), dtype=numpy.uint8)
+        for cy, entries in enumerate(directory):
+            band[:] = 0
+            lines = rows(cy * chunk_size, min(chunk_size, height - cy * chunk_size))
+            for y, line in enumerate(lines):
+                line = line[:width]
+                table = dict((ord(c), codes.get(ord(c), 0)) for c in set(line))
+                band[y, :len(line)] = numpy.frombuffer(
+                    line.translate(table).encode("latin-1"), dtype=numpy.uint8)
+            for cx, entry in enumerate(entries):
+                chunk = band[:, cx * chunk_size:(cx + 1) * chunk_size]
+                if (chunk == chunk[0, 0]).all():
+                    entry["fill"] = chunk[0, 0]
+                else:
+                    entry["data"] = offset
+                    yield chunk.tobytes()
+                    offset += chunk.size
+                ys, xs = numpy.nonzero(is_item[chunk])
+                if len(xs):
+                    entry["items"] = offset
+                    entry["count"] = len(xs)
+                    cells = numpy.column_stack((xs, ys)).astype("<u2").tobytes()
+                    yield cells
+                    offset += len(cells)
+        yield directory.tobytes()
+
+    digest = hashlib.sha1()
+
+    def hashed():
+        for piece in pieces():
+            digest.update(piece)
+            yield piece
+
+    def finish(f):
+        f.seek(STREAM_HEADER.size - 20)
+        f.write(digest.digest())
+
+    write_atomic(filename, hashed(), finish)
+
+
+def convert_level(source, target, chunk_size=STREAM_CHUNK_SIZE):
+    """Write the map file source as a streamed level in target."""
+    level = Level(source, cache=False)
+    write_streamed(target, level.width, level.height, level.tileset, level.key,
+                   lambda y, count: level.map[y:y + count], chunk_size)
+
+
+def _wall_tile(mask):
+    # The branches of Level.render, for one neighbour mask.
+    east = mask & NEAR_E
+    west = mask & NEAR_W
+    if not mask & NEAR_S:
+        if east and west:
+            tile = 1, 2
+        elif east:
+            tile = 0, 2
+        elif west:
+            tile = 2, 2
+        else:
+            tile = 3, 2
+    else:
+        if mask & NEAR_SE and mask & NEAR_SW:
+            tile = 1, 1
+        elif mask & NEAR_SE:
+            tile = 0, 1
+        elif mask & NEAR_SW:
+            tile = 2, 1
+        else:
+            tile = 3, 1
+    over = None
+    if not mask & NEAR_N:
+        if east and west:
+            over = 1, 0
+        elif east:
+            over = 0, 0
+        elif west:
+            over = 2, 0
+        else:
+            over = 3, 0
+    return tile, over
+
+
+_WALL_LOOKUP = [_wall_tile(mask) for mask in range(64)]
+WALL_TILES = numpy.array([x * 16 + y for (x, y), over in _WALL_LOOKUP],
+                         dtype=numpy.int16)
+WALL_OVERS = numpy.array([over[0] * 16 + over[1] if over else -1
+                          for tile, over in _WALL_LOOKUP], dtype=numpy.int16)
+
+_FLAG_TABLES = {}
+
+
+def _flag_table(flag):
+    # Translation table mapping a flags byte to 1 if it has any bit of flag.
+    try:
+        return _FLAG_TABLES[flag]
+    except KeyError:
+        table = bytes(1 if value & flag else 0 for value in range(256))
+        _FLAG_TABLES[flag] = table
+        return table
+
+
+def _key_tables(key):
+    """Return the tile table of a map key, and the flags and tile index of
+    each of its characters."""
+    tile_table = [(0, 3)]
+    cell_flags = {}
+    cell_tiles = {}
+    for char, desc in key.items():
+        flags = 0
+        if desc.get('wall') in TRUE_VALUES:
+            flags |= TILE_WALL
+        if desc.get('block') in TRUE_VALUES:
+            flags |= TILE_BLOCK
+        if 'sprite' in desc:
+            flags |= TILE_SPRITE
+        try:
+            tile = desc['tile'].split(',')
+            tile = int(tile[0]), int(tile[1])
+        except (ValueError, KeyError):
+            tile = 0, 3
+        if tile not in tile_table:
+            tile_table.append(tile)
+        cell_flags[char] = flags
+        cell_tiles[char] = tile_table.index(tile)
+    return tile_table, cell_flags, cell_tiles
+
+
+def _spans(start, length, size):
+    """Split the cells start to start+length of a map row or column into
+    runs that are on the map, as (offset, range of map cells) pairs.
+
+    Negative cells wrap around to the other side and cells past the end
+    are left out, as in Level._index.
+    """
+    spans = []
+    for low, high, shift in ((-size, 0, size), (0, size, 0)):
+        first = max(start, low)
+        last = min(start + length, high)
+        if first < last:
+            spans.append((first - start, range(first + shift, last + shift)))
+    return spans
+
+
+def _autotile(walls, tile_ids, tile_table):
+    """Return the tile and overlay codes of a rectangle, from its walls with
+    a cell around it and its tile ids, see Level.autotile.
+
+    The neighbour masks of all walls are computed at once with array
+    slices and looked up in WALL_TILES and WALL_OVERS.
+    """
+    inner = walls[1:-1, 1:-1]
+    mask = (walls[2:, 1:-1] * NEAR_S | walls[1:-1, 2:] * NEAR_E |
+            walls[1:-1, :-2] * NEAR_W | walls[2:, 2:] * NEAR_SE |
+            walls[2:, :-2] * NEAR_SW | walls[:-2, 1:-1] * NEAR_N)
+    floor = numpy.array([x * 16 + y for x, y in tile_table],
+                        dtype=numpy.int16)
+    tiles = numpy.where(inner, WALL_TILES[mask], floor[tile_ids])
+    overs = numpy.where(inner, WALL_OVERS[mask], -1)
+    return tiles, overs
+
+
+class SparseDistances(dict):
+    """Distances by cell index of the cells a search reached, the others
+    are FlowField.UNREACHED."""
+
+    def __missing__(self, index):
+        return FlowField.UNREACHED
+
+
+class FlowField(object):
+    """Steps to the nearest goal cell from every free cell of a level.
+
+    dist holds a number per cell, UNREACHED where no goal can be reached,
+    found with one breadth-first search from all the goals. With limit the
+    search stops that many steps from the goals, and cells further away
+    are UNREACHED too; dist is then a SparseDistances of the cells reached,
+    so the field costs what the search does, not what the map does.
+    Without it dist is a list over the whole map. When a cell is blocked
+    or freed only the distances that change are worked out again, see
+    block() and free().
+    """
+
+    UNREACHED = 1 << 30
+
+    def __init__(self, level, goals, limit=None):
+        self.level = level
+        self.width = level.width
+        self.cells = level.width * level.height
+        self.limit = self.UNREACHED - 1 if limit is None else limit
+        self.goals = set(y*level.width + x for x, y in goals
+                         if 0 <= x < level.width and 0 <= y < level.height)
+        if limit is None:
+            self.dist = [self.UNREACHED] * self.cells
+        else:
+            self.dist = SparseDistances()
+        seeds = sorted(index for index in self.goals
+                       if not level.flags[index] & TILE_BLOCK)
+        for index in seeds:
+            self.dist[index] = 0
+        self._spread(seeds)
+
+    def _neighbours(self, index):
+        x = index % self.width
+        neighbours = [index - self.width, index + self.width]
+        if x > 0:
+            neighbours.append(index - 1)
+        if x < self.width - 1:
+            neighbours.append(index + 1)
+        return [n for n in neighbours if 0 <= n < self.cells]
+
+    def _spread(self, seeds):
+        """Lower the distances around seeds, cells sorted by distance."""
+        dist = self.dist
+        flags = self.level.flags
+        width = self.width
+        cells = self.cells
+        queue = collections.deque()
+        seeds = collections.deque(seeds)
+        while queue or seeds:
+            # Both are in order of distance, so take the nearer one.
+            if seeds and (not queue or dist[seeds[0]] <= dist[queue[0]]):
+                index = seeds.popleft()
+            else:
+                index = queue.popleft()
+            d = dist[index] + 1
+            if d > self.limit:
+                continue
+            x = index % width
+            for neighbour in (index - width, index + width,
+                              index - 1 if x > 0 else -1,
+                              index + 1 if x < width - 1 else -1):
+                if (0 <= neighbour < cells and d < dist[neighbour] and
+                        not flags[neighbour] & TILE_BLOCK):
+                    dist[neighbour] = d
+                    queue.append(neighbour)
+
+    def _reseed(self, cells):
+        """Give cells the best distance their other neighbours allow."""
+        dist = self.dist
+        seeds = []
+        for index in cells:
+            if index in self.goals:
+                dist[index] = 0
+            else:
+                best = min([dist[n] for n in self._neighbours(index)] +
+                           [self.UNREACHED - 1])
+                if best >= self.limit:
+                    continue
+                dist[index] = best + 1
+            seeds.append(index)
+        seeds.sort(key=dist.__getitem__)
+        self._spread(seeds)
+
+    def free(self, x, y):
+        """Update the distances after the cell at x, y stopped blocking."""
+        self._reseed([y*self.width + x])
+
+    def block(self, x, y):
+        """Update the distances after the cell at x, y started blocking."""
+        dist = self.dist
+        start = y*self.width + x
+        if dist[start] >= self.UNREACHED:
+            return
+        # The cells that were only reached through it are now further away,
+        # found nearest first, so a cell is known to be affected before
+        # the ones one further away are looked at.
+        affected = [start]
+        seen = set(affected)
+        for index in affected:
+            for neighbour in self._neighbours(index):
+                d = dist[index] + 1
+                if neighbour in seen or dist[neighbour] != d:
+                    continue
+                if any(dist[n] == d - 1 and n not in seen
+                       for n in self._neighbours(neighbour)):
+                    continue
+                seen.add(neighbour)
+                affected.append(neighbour)
+        for index in affected:
+            if isinstance(dist, SparseDistances):
+                del dist[index]
+            else:
+                dist[index] = self.UNREACHED
+        self._reseed([index for index in affected[1:]
+                      if not self.level.flags[index] & TILE_BLOCK])
+
+    def direction(self, x, y):
+        """The way to go from x, y, an index of DX and DY, or None."""
+        index = y*self.width + x
+        d = self.dist[index]
+        if d == 0 or d >= self.UNREACHED:
+            return None
+        for way in range(4):
+            nx, ny = x + DX[way], y + DY[way]
+            if (0 <= nx < self.width and 0 <= ny < self.level.height and
+                    self.dist[ny*self.width + nx] == d - 1):
+                return way
+        return None
+
+
+class Pathfinder(object):
+    """Flow fields on a level, cached by their goals and limit.
+
+    Everything heading to the same goals shares one field, so many
+    walkers cost one search, not one each. The size fields used last are
+    kept. Goals that move, like the player, get a field of their own that
+    is replaced when they do, see field(). set_blocking() changes the
+    level and updates them all.
+    """
+
+    def __init__(self, level, size=8):
+        self.level = level
+        self.size = size
+        self.fields = collections.OrderedDict()
+        # The key and field of the last goals that move.
+        self.moving = None
+
+    def field(self, goals, limit=None, moving=False):
+        """The field to goals, searched limit steps out.
+
+        A field to goals that move is stale after their next step, so only
+        the last one is kept, outside the cache of the others.
+        """
+        key = tuple(sorted(goals)), limit
+        if moving:
+            if self.moving is None or self.moving[0] != key:
+                self.moving = key, FlowField(self.level, key[0], limit)
+            return self.moving[1]
+        field = self.fields.get(key)
+        if field is None:
+            field = FlowField(self.level, key[0], limit)
+            self.fields[key] = field
+            while len(self.fields) > self.size:
+                self.fields.popitem(last=False)
+        else:
+            self.fields.move_to_end(key)
+        return field
+
+    def set_blocking(self, x, y, blocking):
+        if self.level.is_blocking(x, y) == blocking:
+            return
+        self.level.set_blocking(x, y, blocking)
+        fields = list(self.fields.values())
+        if self.moving is not None:
+            fields.append(self.moving[1])
+        for field in fields:
+            if blocking:
+                field.block(x, y)
+            else:
+                field.free(x, y)
+
+
+class ChunkedBackground(object):
+    """The background of a level, rendered lazily in square chunks.
+
+    Only the chunks that intersect the camera are rendered, and the least
+    recently used ones are dropped once they take more than budget bytes.
+    """
+
+    def __init__(self, level, chunk_size=16, budget=32 * 1024 * 1024):
+        self.level = level
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.chunk_width = chunk_size * MAP_TILE_WIDTH
+        self.chunk_height = chunk_size * MAP_TILE_HEIGHT
+        self.chunks = collections.OrderedDict()
+        self.memory = 0
+
+    def get_size(self):
+        return (self.level.width * MAP_TILE_WIDTH,
+                self.level.height * MAP_TILE_HEIGHT)
+
+    def chunk(self, cx, cy):
+        key = cx, cy
+        try:
+            image = self.chunks[key]
+        except KeyError:
+            x, y = cx * self.chunk_size, cy * self.chunk_size
+            width = min(self.chunk_size, self.level.width - x)
+            height = min(self.chunk_size, self.level.height - y)
+            image = self.level.render_region(x, y, width, height)
+            self.chunks[key] = image
+            self.memory += _surface_bytes(image)
+        else:
+            self.chunks.move_to_end(key)
+        return image
+
+    def visible_chunks(self, camera):
+        width, height = self.get_size()
+        left = max(camera.left, 0) // self.chunk_width
+        top = max(camera.top, 0) // self.chunk_height
+        right = (min(camera.right, width) - 1) // self.chunk_width
+        bottom = (min(camera.bottom, height) - 1) // self.chunk_height
+        return [(cx, cy) for cy in range(top, bottom + 1)
+                for cx in range(left, right + 1)]
+
+    def draw(self, surface, camera, area=None):
+        """Blit the part of the background under camera onto surface.
+
+        With area, only the chunks under that part of the screen are drawn.
+        """
+        if area is None:
+            visible = self.visible_chunks(camera)
+        else:
+            visible = self.visible_chunks(area.move(camera.topleft))
+        for cx, cy in visible:
+            surface.blit(self.chunk(cx, cy),
+                         (cx * self.chunk_width - camera.left,
+                          cy * self.chunk_height - camera.top))
+        self.evict(len(visible))
+
+    def evict(self, keep=0):
+        # The newest keep chunks are in use, never drop those.
+        while self.memory > self.budget and len(self.chunks) > keep:
+            key, image = self.chunks.popitem(last=False)
+            self.memory -= _surface_bytes(image)
+
+
+class Scenery(object):
+    """The sprites of a level that never move or change, their shadows and
+    the wall overlays, put in a RenderList lazily in square chunks.
+
+    Only the chunks near the camera are made, and the least recently used
+    ones are taken out again once there are more than limit.
+    """
+
+    def __init__(self, level, render_list, skip=(), overlays=True,
+                 chunk_size=16, limit=64):
+        self.level = level
+        self.render_list = render_list
+        # Positions of items that have sprites of their own.
+        self.skip = skip
+        self.overlays = overlays
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.chunks = collections.OrderedDict()
+
+    def chunk(self, cx, cy):
+        key = cx, cy
+        try:
+            entries = self.chunks[key]
+        except KeyError:
+            entries = self.chunks[key] = self.make(cx, cy)
+        else:
+            self.chunks.move_to_end(key)
+        return entries
+
+    def make(self, cx, cy):
+        level = self.level
+        x, y = cx * self.chunk_size, cy * self.chunk_size
+        width = min(self.chunk_size, level.width - x)
+        height = min(self.chunk_size, level.height - y)
+        entries = []
+        for pos, tile in level.items_in(x, y, width, height).items():
+            if pos in self.skip:
+                continue
+            sprite = Sprite(pos, SPRITE_CACHE[tile["sprite"]])
+            # By rows, the order Game.use_level() went through the items.
+            order = pos[1] * level.width + pos[0]
+            shadow = Shadow(sprite)
+            self.render_list.add(shadow, RenderList.SHADOWS, order=order)
+            self.render_list.add(sprite, RenderList.SPRITES, order=order)
+            entries.extend((shadow, sprite))
+        if self.overlays:
+            for (map_x, map_y), image in level.render_overlays(x, y, width, height).items():
+                overlay = pygame.sprite.Sprite()
+                overlay.image = image
+                overlay.rect = image.get_rect().move(map_x*24, map_y*16-16)
+                self.render_list.add(overlay, RenderList.OVERLAYS)
+                entries.append(overlay)
+        return entries
+
+    def show(self, camera):
+        """Make sure everything that can overlap camera is in the list."""
+        # Sprites and overlays reach a tile up and out of their own.
+        view = camera.inflate(2 * MAP_TILE_WIDTH, 2 * MAP_TILE_HEIGHT)
+        chunk_width = self.chunk_size * MAP_TILE_WIDTH
+        chunk_height = self.chunk_size * MAP_TILE_HEIGHT
+        left = max(view.left // chunk_width, 0)
+        top = max(view.top // chunk_height, 0)
+        right = min((view.right - 1) // chunk_width,
+                    (self.level.width - 1) // self.chunk_size)
+        bottom = min((view.bottom - 1) // chunk_height,
+                     (self.level.height - 1) // self.chunk_size)
+        shown = 0
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                self.chunk(cx, cy)
+                shown += 1
+        # Past limit, chunks that went out of view are taken out of the
+        # render list, but all of those in view stay however many they are.
+        while len(self.chunks) > max(self.limit, shown):
+            key, entries = self.chunks.popitem(last=False)
+            for entry in entries:
+                self.render_list.remove(entry)
+
+
+def _surface_bytes(surface):
+    width, height = surface.get_size()
+    return width * height * surface.get_bytesize()
+
+
+def merge_rects(rects):
+    """Merge overlapping rectangles, so no pixel is updated twice."""
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        if rect.width <= 0 or rect.height <= 0:
+            continue
+        index = rect.collidelist(merged)
+        while index >= 0:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+class Hud(object):
+    """Text labels drawn over the map, rendered only when they change.
+
+    Every label has to be shown again each frame, between begin() and
+    changed(), or it is taken off the screen. A Hud that is not enabled
+    ignores everything it is shown.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.labels = {}
+        self.shown = set()
+        self.dirty = []
+
+    def begin(self):
+        self.shown = set()
+
+    def show(self, name, text, pos, colour, font=HUD_FONT):
+        if not self.enabled:
+            return
+        self.shown.add(name)
+        label = self.labels.get(name)
+        if label is not None and label[:3] == (text, pos, colour):
+            return
+        image = TEXT_CACHE.render(font, text, colour)
+        rect = image.get_rect(topleft=pos)
+        if label is not None:
+            self.dirty.append(label[4])
+        self.dirty.append(rect)
+        self.labels[name] = text, pos, colour, image, rect
+
+    def changed(self):
+        """Return the screen areas that changed since the last call."""
+        for name in list(self.labels):
+            if name not in self.shown:
+                self.dirty.append(self.labels.pop(name)[4])
+        dirty, self.dirty = self.dirty, []
+        return dirty
+
+    def draw(self, surface, area=None):
+        for text, pos, colour, image, rect in self.labels.values():
+            if area is None or rect.colliderect(area):
+                surface.blit(image, rect)
+
+
+class Profiler(object):
+    """Times the phases of each frame and keeps the last window frames.
+
+    begin() starts a frame, mark(name) charges the time since the last
+    mark to name, and end() files the frame away. A phase marked twice in
+    a frame gets the sum. count(name, value) keeps a number of the frame
+    that is not a time, like the pixels drawn, in a table of its own. A
+    Profiler that is not enabled does nothing.
+    """
+
+    def __init__(self, window=300, enabled=True):
+        self.enabled = enabled
+        self.names = []
+        self.samples = collections.deque(maxlen=window)
+        self.count_names = []
+        self.count_samples = collections.deque(maxlen=window)
+        self.frames = 0
+        self.frame = {}
+        self.counts = {}
+        self.last = None
+
+    def begin(self):
+        if self.enabled:
+            self.frame = {}
+            self.counts = {}
+            self.last = time.perf_counter()
+
+    def mark(self, name):
+        if not self.enabled or self.last is None:
+            return
+        now = time.perf_counter()
+        self.frame[name] = self.frame.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name, value):
+        if not self.enabled or self.last is None:
+            return
+        self.counts[name] = value
+
+    def end(self):
+        if not self.enabled or self.last is None:
+            return
+        self.mark("other")
+        for name in self.frame:
+            if name not in self.names:
+                self.names.append(name)
+        for name in self.counts:
+            if name not in self.count_names:
+                self.count_names.append(name)
+        self.samples.append([self.frame.get(name, 0.0) for name in self.names])
+        self.count_samples.append([self.counts.get(name, 0) for name in self.count_names])
+        self.frames += 1
+        self.last = None
+
+    def table(self):
+        """The kept frames as an array of seconds, a column per phase."""
+        return _sample_table(self.samples, self.names)
+
+    def count_table(self):
+        """The counts of the kept frames, a column per name."""
+        return _sample_table(self.count_samples, self.count_names)
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Mean, max and percentiles of each phase and the total, in ms."""
+        table = self.table() * 1000
+        if not len(table):
+            return {}
+        return _column_stats(list(zip(self.names, table.T)) +
+                             [("total", table.sum(axis=1))], percentiles)
+
+    def count_summary(self, percentiles=(50, 95, 99)):
+        """Mean, max and percentiles of each count."""
+        table = self.count_table()
+        if not len(table):
+            return {}
+        return _column_stats(zip(self.count_names, table.T), percentiles)
+
+    def dump(self, filename):
+        """Write the kept frames to a .csv file, or the summary and frames
+        to a .json one."""
+        table = self.table() * 1000
+        if filename.endswith(".csv"):
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(self.names + self.count_names)
+                writer.writerows(numpy.hstack((table.round(4), self.count_table())).tolist())
+        else:
+            with open(filename, "w") as f:
+                json.dump({"frames": self.frames, "summary": self.summary(),
+                           "phases": self.names,
+                           "samples": table.round(4).tolist(),
+                           "count_summary": self.count_summary(),
+                           "counts": self.count_names,
+                           "count_samples": self.count_table().tolist()},
+                          f, indent=1)
+
+    def lines(self):
+        """Text lines for the on-screen overlay."""
+        lines = ["{0:<8}{1:>7}{2:>7}".format("ms", "p50", "p95")]
+        for name, stats in self.summary().items():
+            lines.append("{0:<8}{1:>7.2f}{2:>7.2f}".format(
+                name, stats["p50"], stats["p95"]))
+        for name, stats in self.count_summary().items():
+            lines.append("{0:<8}{1:>7.0f}{2:>7.0f}".format(
+                name, stats["p50"], stats["p95"]))
+        return lines
+
+
+def _sample_table(samples, names):
+    # Frames filed before a column was first seen have 0 in it.
+    table = numpy.zeros((len(samples), len(names)))
+    for row, sample in enumerate(samples):
+        table[row, :len(sample)] = sample
+    return table
+
+
+def _column_stats(columns, percentiles):
+    summary = collections.OrderedDict()
+    for name, values in columns:
+        stats = collections.OrderedDict(
+            ("p{0}".format(p), float(value)) for p, value in
+            zip(percentiles, numpy.percentile(values, percentiles)))
+        stats["mean"] = float(values.mean())
+        stats["max"] = float(values.max())
+        summary[name] = stats
+    return summary
+
+
+class Timer(object):
+    """A callback due at an absolute tick of a Scheduler."""
+
+    __slots__ = ('expiry', 'callback', 'args', 'active')
+
+    def __init__(self, expiry, callback, args):
+        self.expiry = expiry
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+
+class Scheduler(object):
+    """Timers kept in a heap by the tick they expire at.
+
+    Nothing is done for a timer until it is due, so advancing the clock
+    costs nothing while no timer expires. shift() moves every pending
+    timer at once by moving the clock instead. Cancelled and fired timers
+    are left in the heaps and skipped when they come up.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.count = 0
+        self._soonest = []
+        self._latest = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, ticks, callback, *args):
+        """Call callback(*args) once ticks more ticks have passed."""
+        timer = Timer(self.now + ticks, callback, args)
+        order = next(self._order)
+        heapq.heappush(self._soonest, (timer.expiry, order, timer))
+        heapq.heappush(self._latest, (-timer.expiry, order, timer))
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.active:
+            timer.active = False
+            self.count -= 1
+            self._compact()
+
+    def reschedule(self, timer, ticks):
+        """Cancel timer and schedule its callback ticks from now instead."""
+        self.cancel(timer)
+        return self.schedule(ticks, timer.callback, *timer.args)
+
+    def remaining(self, timer):
+        return timer.expiry - self.now
+
+    def advance(self, ticks=1):
+        """Move the clock forward, calling the timers that become due."""
+        for timer in self.skip(ticks):
+            timer.callback(*timer.args)
+
+    def skip(self, ticks):
+        """Move the clock forward and return the timers that became due.
+
+        Their callbacks are not called.
+        """
+        self.now += ticks
+        due = []
+        while self._soonest and self._soonest[0][0] <= self.now:
+            timer = heapq.heappop(self._soonest)[2]
+            if timer.active:
+                timer.active = False
+                self.count -= 1
+                due.append(timer)
+        self._compact()
+        return due
+
+    def shift(self, ticks):
+        """Move every pending timer ticks later, or earlier if negative.
+
+        Returns the timers that became due, without calling them.
+        """
+        if ticks < 0:
+            return self.skip(-ticks)
+        self.now -= ticks
+        return []
+
+    def pop_later(self, ticks):
+        """Remove and return the timers due more than ticks from now."""
+        later = []
+        while self._latest and -self._latest[0][0] > self.now + ticks:
+            timer = heapq.heappop(self._latest)[2]
+            if timer.active:
+                timer.active = False
+                self.count -= 1
+                later.append(timer)
+        self._compact()
+        return later
+
+    def _compact(self):
+        # Drop dead entries once they make up most of the heaps.
+        if len(self._soonest) + len(self._latest) <= 4 * self.count + 64:
+            return
+        self._soonest = [entry for entry in self._soonest if entry[2].active]
+        self._latest = [entry for entry in self._latest if entry[2].active]
+        heapq.heapify(self._soonest)
+        heapq.heapify(self._latest)
+
+
+class CropField(object):
+    """The state of every bush, kept in arrays indexed by bush number.
+
+    A growing bush has a timer in clock, its own Scheduler, that sets its
+    ready flag when it runs out, so only the bushes that ripen cost
+    anything on a tick. The numbers of bushes whose state changed since
+    the last take_changed() are kept in changed.
+    """
+
+    def __init__(self, grow_time=None):
+        if grow_time is None:
+            grow_time = 20 * FPS
+        self.grow_time = grow_time
+        self.clock = Scheduler()
+        self.timers = []
+        self.ready = numpy.empty(0, dtype=bool)
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def add(self):
+        """Add an empty bush and return its number."""
+        bush = len(self.timers)
+        if bush == len(self.ready):
+            self.ready = numpy.resize(self.ready, max(16, 2 * bush))
+        self.ready[bush] = False
+        self.timers.append(None)
+        return bush
+
+    def timeleft(self, bush):
+        """Ticks left to grow, 0 when ready and -1 with nothing planted."""
+        if self.ready[bush]:
+            return 0
+        if self.timers[bush] is None:
+            return -1
+        return self.clock.remaining(self.timers[bush])
+
+    def plant(self, bush):
+        self.timers[bush] = self.clock.schedule(self.grow_time, self._ripen, bush)
+        self.changed.add(bush)
+
+    def reset(self, bush):
+        if self.timers[bush] is not None:
+            self.clock.cancel(self.timers[bush])
+            self.timers[bush] = None
+        self.ready[bush] = False
+        self.changed.add(bush)
+
+    def is_empty(self, bush):
+        return not self.ready[bush] and self.timers[bush] is None
+
+    def is_ready(self, bush):
+        return bool(self.ready[bush])
+
+    def _ripen(self, bush):
+        self.timers[bush] = None
+        self.ready[bush] = True
+        self.changed.add(bush)
+
+    def grow(self, ticks=1):
+        """Advance every growing bush by ticks."""
+        self.clock.advance(ticks)
+
+    def shift(self, ticks):
+        """Move the timers of growing bushes by ticks.
+
+        Bushes that run out of time are emptied and their number is
+        returned, so they can be paid out. Bushes pushed back past the
+        whole grow time are emptied for nothing.
+        """
+        harvested = self.clock.shift(ticks)
+        for timer in harvested + self.clock.pop_later(self.grow_time):
+            self.reset(timer.args[0])
+        return len(harvested)
+
+    def take_changed(self):
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def times(self):
+        """The timeleft() of every bush, as an int32 array."""
+        return numpy.array([self.timeleft(bush) for bush in range(len(self))],
+                           dtype=numpy.int32)
+
+    def set_times(self, times):
+        """Put every bush back in the state given by times()."""
+        for bush, ticks in enumerate(times):
+            self.reset(bush)
+            if ticks == 0:
+                self.ready[bush] = True
+            elif ticks > 0:
+                self.timers[bush] = self.clock.schedule(int(ticks), self._ripen, bush)
+
+
+def write_atomic(filename, data, finish=None):
+    """Write data to filename, so that it has either the old or new data.
+
+    data is bytes, or an iterable of bytes to write one after another.
+    finish(f), if given, is called with the file once data is written,
+    to fill in what is only known by then.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                f.writelines(data)
+            if finish is not None:
+                finish(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def read_save(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def level_cache_path(filename, source):
+    """Where the compiled copy of the map in filename, with text source, goes."""
+    digest = hashlib.sha1(source).hexdigest()
+    folder, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, LEVEL_CACHE_DIR,
+                        "{0}-{1}.level".format(name, digest))
+
+
+def prune_level_cache(path):
+    """Remove the compiled copies of other versions of the map of path."""
+    folder, name = os.path.split(path)
+    prefix = name[:-len(".level") - 40]
+    for other in os.listdir(folder):
+        if (other != name and other.startswith(prefix) and
+                len(other) == len(name) and other.endswith(".level")):
+            try:
+                os.remove(os.path.join(folder, other))
+            except OSError:
+                pass
+
+
+class SaveWorker(object):
+    """Reads and writes saved games and recordings on a thread, away from
+    the frame.
+
+    save(), record() and load() return at once and the jobs are done in order. What
+    came of them is handed back by poll() as (kind, data, error) tuples,
+    with data the bytes read by a load. With background=False the work is
+    done on the spot instead, so headless runs give the same result every
+    time.
+    """
+
+    def __init__(self, background=True):
+        self.results = queue.Queue()
+        self.jobs = None
+        if background:
+            self.jobs = queue.Queue()
+            threading.Thread(target=self._work, args=(self.jobs,),
+                             daemon=True).start()
+
+    def save(self, filename, data):
+        self._put(("save", filename, data))
+
+    def record(self, filename, data):
+        """Write a recording, see Recorder.finish()."""
+        self._put(("record", filename, data))
+
+    def load(self, filename):
+        self._put(("load", filename, None))
+
+    def poll(self):
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return done
+
+    def wait(self):
+        """Block until every job so far is done."""
+        if self.jobs is not None:
+            self.jobs.join()
+
+    def close(self):
+        """Do the jobs so far and stop the thread, later jobs are done on
+        the spot."""
+        if self.jobs is not None:
+            self.jobs.put(None)
+            self.jobs.join()
+            self.jobs = None
+
+    def _put(self, job):
+        if self.jobs is None:
+            self._run(job)
+        else:
+            self.jobs.put(job)
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is not None:
+                self._run(job)
+            jobs.task_done()
+            if job is None:
+                break
+
+    def _run(self, job):
+        kind, filename, data = job
+        error = None
+        try:
+            if kind in ("save", "record"):
+                write_atomic(filename, data)
+            else:
+                data = read_save(filename)
+        except (IOError, OSError) as e:
+            error = e
+        self.results.put((kind, data, error))
+
+
+class Loader(object):
+    """Calls function(*args) on a thread and keeps what it returns.
+
+    result() waits for it if it is not done() yet, and raises what the
+    function raised, if anything.
+    """
+
+    def __init__(self, function, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(function, args),
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self, function, args):
+        try:
+            self.value = function(*args)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Recorder(object):
+    """Records the keys of every tick of a game and the state they led to.
+
+    Made with the game it records, which calls record() after each step.
+    The game must be at rest, as a saved state only has the tile each
+    sprite is on. finish() returns the recording, see REPLAY_HEADER.
+    """
+
+    def __init__(self, game):
+        self.level = game.level.filename.encode("utf-8")
+        self.start = game.save_state()
+        self.runs = []
+        self.hashes = []
+
+    def record(self, keys, pressed_key, state_hash):
+        held = 0
+        for bit, key in enumerate(CONTROL_KEYS):
+            if keys[key]:
+                held |= 1 << bit
+        pressed = 0
+        if pressed_key in CONTROL_KEYS:
+            pressed = CONTROL_KEYS.index(pressed_key) + 1
+        run = self.runs[-1] if self.runs else None
+        if run is not None and run[1:] == [held, pressed] and run[0] < 0xFFFF:
+            run[0] += 1
+        else:
+            self.runs.append([1, held, pressed])
+        self.hashes.append(state_hash)
+
+    def finish(self):
+        return b"".join(
+            [REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, len(self.start),
+                                len(self.hashes), len(self.level)),
+             self.level, self.start] +
+            [REPLAY_RUN.pack(*run) for run in self.runs] +
+            [numpy.array(self.hashes, dtype="<u4").tobytes()])
+
+
+class RecordedKeys(object):
+    """The held keys of a recorded tick, like pygame.key.get_pressed()."""
+
+    def __init__(self, held):
+        self.held = held
+
+    def __getitem__(self, key):
+        try:
+            return bool(self.held >> CONTROL_KEYS.index(key) & 1)
+        except ValueError:
+            return False
+
+
+class Replay(object):
+    """A recording from Recorder, read back.
+
+    level is the map file it was played on, start the saved state the game
+    started from, ticks the keys and pressed key of every tick and hashes
+    the state_hash() after it.
+    """
+
+    def __init__(self, data):
+        magic, version, size, count, name = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("not a recording")
+        if version != REPLAY_VERSION:
+            raise ValueError("unsupported recording version %d" % version)
+        offset = REPLAY_HEADER.size
+        self.level = data[offset:offset + name].decode("utf-8")
+        offset += name
+        self.start = data[offset:offset + size]
+        offset += size
+        self.ticks = []
+        while len(self.ticks) < count:
+            ticks, held, pressed = REPLAY_RUN.unpack_from(data, offset)
+            offset += REPLAY_RUN.size
+            pressed_key = CONTROL_KEYS[pressed - 1] if pressed else None
+            self.ticks.extend([(RecordedKeys(held), pressed_key)] * ticks)
+        self.hashes = numpy.frombuffer(data, "<u4", count, offset).tolist()
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+def load_level(filename):
+    """Load a level and everything about it that can be done off-screen."""
+    with open(filename, "rb") as f:
+        if f.read(len(STREAM_MAGIC)) == STREAM_MAGIC:
+            return StreamedLevel(filename)
+    level = Level(filename)
+    level.autotile()
+    return level
+
+
+class LevelManager(object):
+    """Plays map files one after another.
+
+    Each level is loaded on a Loader while the one before it is played,
+    so at most one level is held besides the one being played. index is
+    the number of the level being played, -1 before the first.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.index = -1
+        self.loader = None
+        self.preload()
+
+    def preload(self):
+        following = self.index + 1
+        self.loader = None
+        if following < len(self.filenames):
+            self.loader = Loader(load_level, self.filenames[following])
+
+    def has_next(self):
+        return self.loader is not None
+
+    def ready(self):
+        return self.loader is None or self.loader.done()
+
+    def next(self):
+        """Return the next level, waiting for it if it is still loading."""
+        level = self.loader.result()
+        self.index += 1
+        self.preload()
+        return level
 
 
 class Game(object):
     
-    def __init__(self):
+    def __init__(self, level=None, headless=False, levels=LEVELS):
         self.screen = pygame.display.get_surface()
+        # Without a window nothing is drawn or played, see step().
+        self.headless = headless
         self.pressed_key = None
         self.game_over = False
-        self.shadows = pygame.sprite.RenderUpdates()
-        self.sprites = SortedUpdates()
-        self.overlays = pygame.sprite.RenderUpdates()
         
         self.features = ["bush", "forward", "backward", "stop", "crate"]
-        self.interact = []
         
         
-        self.bushstuff = []
         self.potato = 1000
         self.weight = False
         self.weightnum = 250
         self.maxcapacity = 500
+        self.forward_cost = 20
+        self.stop_cost = 250
+        self.backward_cost = 40
         self.donation = 0
         self.needed = 1000
+        # The game clock, which stands still while time is stopped, and the
+        # real one, which runs the time stop itself.
+        self.clock = Scheduler()
+        self.timers = Scheduler()
+        self.deadline_timer = None
+        self.stop_timer = None
         self.deadline = 125 * FPS
         self.stoppedtime = 25 * FPS
         
@@ -261,45 +2375,411 @@ class Game(object):
         
         self.good_ending = False
         
-        self.use_level(Level())        
+        self.camera = pygame.Rect((0, 0), self.screen.get_size())
+        self.hud = Hud(enabled=not headless)
+        self.sounds = None
+        if not headless:
+            self.sounds = SoundBank(SOUNDS, background=True)
+        self.frame_pixels = 0
+        # How far the last frame drawn was between the last two ticks, and
+        # how many ticks were thrown away because the game fell behind.
+        self.alpha = 1.0
+        self.dropped_ticks = 0
+        # Where the time of each frame goes, shown on screen with F3 and
+        # written to profile.csv and profile.json with F4.
+        self.profiler = Profiler(enabled=not headless)
+        self.show_profile = False
+        self.profile_lines = []
+        # Records the keys of every tick while F5 is on, see Recorder.
+        # record_next starts it on the next tick nothing is walking.
+        self.recorder = None
+        self.record_next = False
+        # The last few saved states, newest last, the saved game files
+        # and a state read back to be put in place on the next step.
+        self.snapshots = collections.deque(maxlen=SNAPSHOTS)
+        self.saves = SaveWorker(background=not headless)
+        self.loaded = None
+        self.save_status = None
+        self.status_timer = None
+        # Which part of main() runs: "title", "play", "paused", "over" or
+        # None once it is done, and the still screens, loaded up front.
+        self.scene = "title"
+        self.screens = {}
+        if not headless:
+            self.screens = dict((name, load_image(name)) for name in SCREENS)
+        
+        # With a window the levels are loaded in the background, the first
+        # one while the title screen is up.
+        self.levels = None
+        if level is None and not headless:
+            self.levels = LevelManager(levels)
+        else:
+            self.use_level(level or Level())        
 
     def use_level(self, level):
-        global last_save
-        
-        def around(pos, name):
-            x, y = pos
-            place = [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
-            thing = [name, place]
-            if name == "bush":
-                is_done = False
-                timeleft = -1
-                self.bushstuff.append([place, is_done, timeleft])
-            self.interact.append(thing)        
-    
-        self.shadows = pygame.sprite.RenderUpdates()
-        self.sprites = SortedUpdates()
-        self.overlays = pygame.sprite.RenderUpdates()
+        """Play level, with nothing of the level before kept.
+
+        Only the sprites that walk or animate are made here, the rest of
+        the level is looked at as it is shown or used. Everything that
+        belongs to a level is set here and nowhere else.
+        """
+        # The tiles to head for by feature name, found when a walker first
+        # heads for one, see goal_cells().
+        self.goal_places = {}
+        # Bushes get a number in self.crops when they are first used, see
+        # bush_at(), so an untouched bush costs nothing.
+        self.crops = CropField()
+        self.bushes = {}
+        # Where the sprite of each bush in self.crops is, and rects to redraw.
+        self.crop_rects = []
+        self.redraw = []
+        # Screen rect and image of every sprite as of the last frame drawn.
+        self.drawn = {}
+        self.snapshots.clear()
+        self.walkers = []
+        self.paths = Pathfinder(level)
+        self.render_list = RenderList()
+        # The sprites that walk or animate and their shadows, the only ones
+        # step() has to update and saved games keep.
+        self.movers = []
+        self.mover_shadows = []
         self.level = level
+        SPRITE_CACHE.pack(set(tile["sprite"] for pos, tile in level.items.items()) |
+                          {"player.png", "shadow.png"})
+        # The sprites that never move or change are left to self.scenery.
+        own = set()
         for pos, tile in level.items.items():
-            if tile['name'] in self.features:
-                x, y = pos
-                around(pos, tile['name'])
-                
+            frames = SPRITE_CACHE[tile["sprite"]]
             if tile.get("player") in ('true', '1', 'yes', 'on'):
                 sprite = Player(pos)
                 self.player = sprite
+            elif "goal" in tile:
+                # Walkers leave their tile, so it must not block.
+                sprite = Walker(pos, frames, tile["goal"])
+                self.walkers.append(sprite)
+                level.set_blocking(pos[0], pos[1], False)
+            elif len(frames[0]) > 1:
+                sprite = Sprite(pos, frames)
             else:
-                sprite = Sprite(pos, SPRITE_CACHE[tile["sprite"]])
-            self.sprites.add(sprite)
-            self.shadows.add(Shadow(sprite))
-        self.background, overlays = self.level.render()
-        for (x, y), image in overlays.items():
-            overlay = pygame.sprite.Sprite(self.overlays)
-            overlay.image = image
-            overlay.rect = image.get_rect().move(x*24, y*16-16)
-
-    def control(self):
-        keys = pygame.key.get_pressed()
+                continue
+            own.add(pos)
+            order = pos[1] * level.width + pos[0]
+            shadow = Shadow(sprite)
+            self.movers.append(sprite)
+            self.mover_shadows.append(shadow)
+            self.render_list.add(shadow, RenderList.SHADOWS, True, order)
+            self.render_list.add(sprite, RenderList.SPRITES, True, order)
+        self.background = ChunkedBackground(self.level)
+        self.scenery = Scenery(self.level, self.render_list, own,
+                               overlays=not self.headless)
+        self.drawn_camera = None
+
+    def goal_cells(self, goal):
+        """The tiles to head for to reach goal, see Walker."""
+        if goal == "player":
+            return [self.player.pos]
+        cells = self.goal_places.get(goal)
+        if cells is None:
+            cells = self.goal_places[goal] = []
+            for (x, y), tile in self.level.items.items():
+                if tile["name"] == goal:
+                    cells.extend([(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)])
+        return cells
+
+    def bush_at(self, pos):
+        """The number in self.crops of the bush at pos, given it the first
+        time it is asked for."""
+        bush = self.bushes.get(pos)
+        if bush is None:
+            bush = self.bushes[pos] = self.crops.add()
+            image = SPRITE_CACHE[self.level.items[pos]["sprite"]][0][0]
+            self.crop_rects.append(image.get_rect(
+                midbottom=(pos[0]*24+12, pos[1]*16+16)))
+        return bush
+
+    def nearby(self, pos):
+        """What can be interacted with from pos, as (name, bush) pairs, bush
+        None for anything but bushes. By rows, like the items of a level."""
+        x, y = pos
+        found = []
+        for near in ((x, y - 1), (x - 1, y), (x + 1, y), (x, y + 1)):
+            tile = self.level.items.get(near)
+            if tile is None or tile["name"] not in self.features:
+                continue
+            bush = self.bush_at(near) if tile["name"] == "bush" else None
+            found.append((tile["name"], bush))
+        return found
+
+    def steer(self):
+        """Start every walker that stands still on its way to its goal.
+
+        The player moves, so a field to the player only lasts until the
+        next step and is searched CHASE_RANGE steps out, not over the
+        whole map. Walkers further away than that wait.
+        """
+        goals = {}
+        for walker in self.walkers:
+            if walker.animation is not None:
+                continue
+            if walker.goal not in goals:
+                chase = walker.goal == "player"
+                goals[walker.goal] = self.paths.field(
+                    self.goal_cells(walker.goal),
+                    CHASE_RANGE if chase else None, moving=chase)
+            way = goals[walker.goal].direction(*walker.pos)
+            if way is not None:
+                walker.animation = walker.walk_animation(way)
+
+    def next_level(self):
+        """Swap in the next level, loaded while this one was played.
+
+        A recording is of one level, so it is written out first.
+        """
+        if self.recorder is not None:
+            self.toggle_recording()
+        self.use_level(self.levels.next())
+        self.donation = 0
+        self.deadline = 125 * FPS
+        self.set_status("LEVEL {0}".format(self.levels.index + 1))
+
+    def _get_deadline(self):
+        return max(self.clock.remaining(self.deadline_timer), 0)
+
+    def _set_deadline(self, ticks):
+        if self.deadline_timer is None:
+            self.deadline_timer = self.clock.schedule(ticks, self.out_of_time)
+        else:
+            self.deadline_timer = self.clock.reschedule(self.deadline_timer, ticks)
+
+    deadline = property(_get_deadline, _set_deadline)
+
+    def _get_stoppedtime(self):
+        if self.stop_timer is None:
+            return self._stoppedtime
+        return self.timers.remaining(self.stop_timer) - 1
+
+    def _set_stoppedtime(self, ticks):
+        if self.stop_timer is None:
+            self._stoppedtime = ticks
+        else:
+            self.stop_timer = self.timers.reschedule(self.stop_timer, ticks + 1)
+
+    stoppedtime = property(_get_stoppedtime, _set_stoppedtime)
+
+    def out_of_time(self):
+        if self.needed != 0:
+            self.game_over = True
+
+    def stop_time(self):
+        self.is_time_stopped = True
+        self.stop_timer = self.timers.schedule(self._stoppedtime + 1, self.resume_time)
+
+    def resume_time(self):
+        self.is_time_stopped = False
+        self.stop_timer = None
+        self._stoppedtime = 10 * FPS
+
+    def save_state(self):
+        """Return the state of the game as bytes, see load_state()."""
+        positions = numpy.array([sprite.pos for sprite in self.movers],
+                                dtype=numpy.int32)
+        # Bushes left out are empty when loaded, so only the others are
+        # kept, by rows, as the order they got their numbers in depends on
+        # the game.
+        times = self.crops.times()
+        places = numpy.array(list(self.bushes), dtype=numpy.int32).reshape(-1, 2)
+        used = numpy.flatnonzero(times >= 0)
+        used = used[numpy.lexsort((places[used, 0], places[used, 1]))]
+        bushes = numpy.column_stack((places[used], times[used]))
+        return b"".join((
+            SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION),
+            SAVE_STATE.pack(self.level.digest, self.potato, self.donation,
+                            self.needed, self.deadline, self.stoppedtime,
+                            self.is_time_stopped, self.weight, len(positions),
+                            len(bushes)),
+            positions.astype("<i4").tobytes(),
+            bushes.astype("<i4").tobytes()))
+
+    def load_state(self, data):
+        """Restore a state from save_state() of a game on the same level."""
+        magic, version = SAVE_HEADER.unpack_from(data)
+        if magic != SAVE_MAGIC:
+            raise ValueError("not a saved game")
+        if version != SAVE_VERSION:
+            raise ValueError("unsupported save version %d" % version)
+        offset = SAVE_HEADER.size
+        (digest, potato, donation, needed, deadline, stoppedtime, stopped,
+         weight, sprites, bushes) = SAVE_STATE.unpack_from(data, offset)
+        if digest != self.level.digest or sprites != len(self.movers):
+            raise ValueError("saved game is for another level")
+        offset += SAVE_STATE.size
+        positions = numpy.frombuffer(data, "<i4", 2 * sprites, offset)
+        offset += positions.nbytes
+        saved = numpy.frombuffer(data, "<i4", 3 * bushes, offset).reshape(-1, 3)
+        places = [tuple(pos) for pos in saved[:, :2].tolist()]
+        for pos in places:
+            tile = self.level.items.get(pos)
+            if tile is None or tile["name"] != "bush":
+                raise ValueError("saved game is for another level")
+        numbers = [self.bush_at(pos) for pos in places]
+        times = numpy.full(len(self.crops), -1, dtype=numpy.int32)
+        times[numbers] = saved[:, 2]
+
+        self.potato = potato
+        self.weight = bool(weight)
+        self.donation = donation
+        self.needed = needed
+        self.deadline = deadline
+        if self.stop_timer is not None:
+            self.timers.cancel(self.stop_timer)
+            self.stop_timer = None
+        self.is_time_stopped = False
+        self._stoppedtime = stoppedtime
+        if stopped:
+            self.stop_time()
+        for sprite, pos in zip(self.movers, positions.reshape(-1, 2)):
+            sprite.pos = int(pos[0]), int(pos[1])
+        for shadow in self.mover_shadows:
+            shadow.update()
+        self.player.animation = None
+        for walker in self.walkers:
+            walker.animation = None
+        self.crops.set_times(times)
+
+    def snapshot(self):
+        """Keep the current state in memory and return it."""
+        data = self.save_state()
+        self.snapshots.append(data)
+        return data
+
+    def set_status(self, text, ticks=2 * FPS):
+        """Show how saving or loading went for the next ticks."""
+        self.save_status = text
+        if self.status_timer is not None:
+            self.timers.cancel(self.status_timer)
+        self.status_timer = self.timers.schedule(ticks, self.clear_status)
+
+    def clear_status(self):
+        self.save_status = None
+        self.status_timer = None
+
+    def apply_saves(self):
+        """Take in finished saves and loads, and put a loaded state in place.
+
+        A loaded state waits for the player to finish walking, or the rest
+        of the walk would carry on from the loaded tile.
+        """
+        for kind, data, error in self.saves.poll():
+            if kind == "save":
+                self.set_status("SAVE FAILED" if error else "GAME STATE SAVED")
+            elif kind == "record":
+                self.set_status("RECORDING FAILED" if error else "RECORDING SAVED")
+            elif error is None:
+                self.loaded = data
+            else:
+                self.set_status("NO SAVED GAME TO LOAD")
+        if self.loaded is not None and self.player.animation is None:
+            data, self.loaded = self.loaded, None
+            try:
+                self.load_state(data)
+            except (ValueError, struct.error):
+                self.set_status("NO SAVED GAME TO LOAD")
+            else:
+                self.set_status("GAME STATE LOADED")
+        if self.save_status is not None:
+            self.hud.show("save", self.save_status, (550, 210), (255,255,102), MESSAGE_FONT)
+
+    def play_sound(self, filename):
+        if self.sounds is not None:
+            self.sounds.play(filename)
+
+    def update_camera(self):
+        """Center the camera on the player, keeping it inside the map."""
+        width, height = self.background.get_size()
+        player = self.player.shown_rect(self.alpha)
+        if width <= self.camera.width:
+            self.camera.left = 0
+        else:
+            left = player.centerx - self.camera.width // 2
+            self.camera.left = min(max(left, 0), width - self.camera.width)
+        if height <= self.camera.height:
+            self.camera.top = 0
+        else:
+            top = player.centery - self.camera.height // 2
+            self.camera.top = min(max(top, 0), height - self.camera.height)
+
+    def draw_frame(self, alpha=None):
+        """Redraw the parts of the screen that changed and update them.
+
+        Moving sprites are drawn alpha of the way from where they were a
+        tick ago to where they are, see Sprite.shown_rect(). Without alpha
+        the one of the last frame is used.
+
+        Sprites that moved or changed image, the rects in self.redraw and
+        HUD labels that changed are cleared back to the background and
+        redrawn, together with anything else on top of them. Scrolling the
+        camera redraws the whole screen. Only the part of self.render_list
+        under the camera is looked at, after self.scenery filled it in
+        there, and all of it that gets redrawn goes in one Surface.blits()
+        call.
+        frame_pixels counts the pixels pushed to the display, and is kept
+        by the profiler as "pixels".
+        """
+        if alpha is not None:
+            self.alpha = alpha
+        self.update_camera()
+        screen_rect = self.screen.get_rect()
+        offset = -self.camera.left, -self.camera.top
+        shown = []
+        drawn = {}
+        dirty = []
+        self.scenery.show(self.camera)
+        for sprite, image, rect in self.render_list.gather(self.camera, self.alpha):
+            rect = rect.move(offset)
+            shown.append((image, rect))
+            drawn[sprite] = rect, image
+            old = self.drawn.pop(sprite, None)
+            if old != (rect, image):
+                dirty.append(rect)
+                if old is not None:
+                    dirty.append(old[0])
+        # Whatever is left went off the screen or out of the level.
+        dirty.extend(rect for rect, image in self.drawn.values())
+        dirty.extend(self.hud.changed())
+        dirty.extend(rect.move(offset) for rect in self.redraw)
+        self.redraw = []
+        self.drawn = drawn
+        if self.drawn_camera != self.camera.topleft:
+            self.drawn_camera = self.camera.topleft
+            dirty = [screen_rect]
+        dirty = merge_rects(rect.clip(screen_rect) for rect in dirty)
+        self.profiler.mark("dirty")
+        # The areas do not overlap, so each can be cleared first and the
+        # sprites clipped to them with the area of their blit.
+        blits = []
+        for area in dirty:
+            self.screen.set_clip(area)
+            self.screen.fill((0, 0, 0), area)
+            self.background.draw(self.screen, self.camera, area)
+            for image, rect in shown:
+                clip = rect.clip(area)
+                if clip:
+                    blits.append((image, clip, clip.move(-rect.x, -rect.y)))
+        self.screen.set_clip(None)
+        self.screen.blits(blits, False)
+        for area in dirty:
+            self.screen.set_clip(area)
+            self.hud.draw(self.screen, area)
+        self.screen.set_clip(None)
+        self.profiler.mark("draw")
+        pygame.display.update(dirty)
+        self.profiler.mark("flip")
+        self.frame_pixels = sum(area.width * area.height for area in dirty)
+        self.profiler.count("pixels", self.frame_pixels)
+
+    def control(self, keys=None):
+        if keys is None:
+            keys = pygame.key.get_pressed()
 
         def pressed(key):
             return self.pressed_key == key or keys[key]
@@ -325,69 +2805,46 @@ class Game(object):
                     time = -5
                 else:
                     time = 20
-                for j in self.bushstuff:
-                    if j[2] > 0:
-                        j[2] = j[2] + time * FPS
-                        bonus = 0
-                        if self.is_time_stopped is True:
-                            bonus = 50                        
-                        if j[2] <= 0:
-                            self.potato += 50 + bonus    
-                            j[1] = False
-                            j[2] = -1   
-                        if j[2] > 20 * FPS:
-                            j[1] = False
-                            j[2] = -1
+                harvested = self.crops.shift(time * FPS)
+                bonus = 0
+                if self.is_time_stopped is True:
+                    bonus = 50                        
+                self.potato += harvested * (50 + bonus)
             """Interact with an object"""
             x, y = self.player.pos
             pos = x, y
-            for i in self.interact:
-                if pos in i[1] and i[0] == 'forward':
-                    if self.potato >= 20:
-                        pygame.mixer.music.stop()
-                        music = pygame.mixer.Sound('rewind.wav')
-                        music.play()                        
+            for name, bush in self.nearby(pos):
+                if name == 'forward':
+                    if self.potato >= self.forward_cost:
+                        self.play_sound('rewind.wav')
                         self.deadline -= 5 * FPS
-                        self.potato -= 20         
+                        self.potato -= self.forward_cost
                         potato_affect(True)
-                if pos in i[1] and i[0] == 'stop' and self.is_time_stopped is False:
-                    if self.potato >= 250:
-                        pygame.mixer.music.stop()
-                        music = pygame.mixer.Sound('stoptime.wav')
-                        music.play()                           
-                        self.is_time_stopped = True
-                        self.potato -= 250                
-                if pos in i[1] and i[0] == 'backward':
-                    if self.potato >= 40:
-                        pygame.mixer.music.stop()
-                        music = pygame.mixer.Sound('rewind.wav')
-                        music.play()                        
+                if name == 'stop' and self.is_time_stopped is False:
+                    if self.potato >= self.stop_cost:
+                        self.play_sound('stoptime.wav')
+                        self.stop_time()
+                        self.potato -= self.stop_cost
+                if name == 'backward':
+                    if self.potato >= self.backward_cost:
+                        self.play_sound('rewind.wav')
                         self.deadline += 15 * FPS
-                        self.potato -= 40
+                        self.potato -= self.backward_cost
                         potato_affect(False)
-                if pos in i[1] and self.potato >= 0 and self.maxcapacity > self.potato and i[0] == 'bush':
+                if name == 'bush' and self.potato >= 0 and self.maxcapacity > self.potato:
                     bonus = 0
                     if self.is_time_stopped is True:
                         bonus = 50
-                    for j in self.bushstuff:
-                        if pos in j[0]:
-                            bush = self.bushstuff.index(j)
-                                      
-                    if self.bushstuff[bush][1] is False and self.bushstuff[bush][2] < 0:
-                        self.bushstuff[bush][2] = 20 * FPS
-                        myfont = pygame.font.SysFont("Ugo", 20)
-                        scoretext = myfont.render("POTATO PLANTED!", 1, (124,252,0))
-                        self.screen.blit(scoretext, (5, 330))                         
-                    elif self.bushstuff[bush][1] is True and self.bushstuff[bush][2] == 0:
+                    if self.crops.is_empty(bush):
+                        self.crops.plant(bush)
+                        self.hud.show("bush", "POTATO PLANTED!", (5, 330), (124,252,0))
+                    elif self.crops.is_ready(bush):
                         self.potato += 50 + bonus    
-                        self.bushstuff[bush][1] = False
-                        self.bushstuff[bush][2] = -1
+                        self.crops.reset(bush)
                     else:
-                        myfont = pygame.font.SysFont("Ugo", 20)
-                        scoretext = myfont.render("TIME LEFT TO GROW: {0}".format(self.bushstuff[bush][2] // FPS), 1, (255,255,102))
-                        self.screen.blit(scoretext, (5, 330))                        
+                        self.hud.show("bush", "TIME LEFT TO GROW: {0}".format(self.crops.timeleft(bush) // FPS), (5, 330), (255,255,102))
                 
-                if pos in i[1] and self.potato > 0  and i[0] == 'crate':
+                if name == 'crate' and self.potato > 0:
                     coef = 0
                     maximum = 500
                     while maximum != 0:
@@ -400,8 +2857,6 @@ class Game(object):
                     self.donation += coef
                         
         
-        keys = pygame.key.get_pressed()
-        
         if (keys[pg.K_UP] and keys[pg.K_LSHIFT]) or keys[pg.K_UP]:
             is_run = False
             if (keys[pg.K_LSHIFT] and self.weight == False) or (keys[pg.K_LSHIFT] and self.is_time_stopped is True):
@@ -430,207 +2885,271 @@ class Game(object):
             else:
                 self.is_game_paused = False
         elif keys[pg.K_o]:
-            if self.is_time_stopped is False:
-                myfont = pygame.font.SysFont("monospace", 16)
-                scoretext = myfont.render("GAME STATE SAVED", 1, (255,255,102))
-                self.screen.blit(scoretext, (550, 210))             
-                f = open("save.txt", "w", encoding="utf-8")
-                x, y = self.player.pos            
-                f.write(str(self.potato))
-                f.write('\n')
-                f.write(str(self.donation))
-                f.write('\n')
-                f.write(str(self.deadline))
-                f.write('\n')
-                f.write(str(x))
-                f.write('\n')
-                f.write(str(y))
-                f.write('\n')
-                #f.write(str(self.is_time_stopped))
-                #f.write('\n')
-                #print(str(self.is_time_stopped))
-                f.close()
-            else:
-                myfont = pygame.font.SysFont("monospace", 16)
-                scoretext = myfont.render("CANNOT SAVE DURING TIME STOP", 1, (255,255,102))
-                self.screen.blit(scoretext, (550, 210))                     
+            self.saves.save(SAVE_FILE, self.snapshot())
+            self.set_status("SAVING...")
                                     
         elif keys[pg.K_i]:
-            if self.is_time_stopped is False:
-                myfont = pygame.font.SysFont("monospace", 16)
-                scoretext = myfont.render("GAME STATE LOADED", 1, (255,255,102))
-                self.screen.blit(scoretext, (550, 210))            
-                f = open("save.txt", "r", encoding="utf-8")
-                lineList = [line.rstrip('\n') for line in open('save.txt')]
-                self.potato = int(lineList[0])
-                self.donation = int(lineList[1])
-                self.deadline = int(lineList[2])
-                x = int(lineList[3])
-                y = int(lineList[4])
-                self.player.pos = (x, y)
-                #self.is_time_stopped = bool(lineList[5]) 
-                #print(bool(lineList[5]))
-                f.close()
+            if self.snapshots:
+                self.loaded = self.snapshots[-1]
             else:
-                myfont = pygame.font.SysFont("monospace", 16)
-                scoretext = myfont.render("CANNOT LOAD DURING TIME STOP", 1, (255,255,102))
-                self.screen.blit(scoretext, (550, 210))                  
+                self.saves.load(SAVE_FILE)
+            self.set_status("LOADING...")
         self.pressed_key = None        
         
 
-    def main(self):
-        def start_game():
-            self.screen.fill((0, 0, 0))
-            start_img = pygame.image.load('start.png')
-            start_img_rect = start_img.get_rect()
-            start_img_rect.center = (MAP_TILE_WIDTH * 35 / 2, MAP_TILE_HEIGHT * 23 / 2)
-            self.screen.blit(start_img, start_img_rect)
-            exit = False
-            while True:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN:
-                        exit = True
-                if exit == True:
-                    break
-                pygame.display.update()
-                
-        def game_over():
-            self.screen.fill((0, 0, 0))
-            if self.good_ending is True:
-                state = "win.png"
-            else:
-                state = "end.png"
-            end_img = pygame.image.load(state)
-            end_img_rect = end_img.get_rect()
-            end_img_rect.center = (MAP_TILE_WIDTH * 35 / 2, MAP_TILE_HEIGHT * 23 / 2)
-            self.screen.blit(end_img, end_img_rect)
-            exit = False
-            while True:
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN:
-                        exit = True
-                        pygame.display.quit()
-                        pygame.quit()
-                if exit == True:
-                    break
-                pygame.display.update() 
-        
+    def step(self, keys):
+        """Advance the game by one tick, with keys as the held keys.
+
+        This is all of the game logic and none of the drawing, so it can
+        run without a window as fast as the CPU allows.
+        """
         def timestop():             
-            scoretext = myfont.render("TIME STOPPED", 1, (0,0,255))                
-            self.screen.blit(scoretext, (5, 290)) 
-            scoretext = myfont.render("SECONDS LEFT: {0}".format(self.stoppedtime // FPS), 1, (0,0,255))
-            self.screen.blit(scoretext, (5, 310)) 
-            if self.stoppedtime == 0:
-                self.is_time_stopped = False
-                self.stoppedtime = 10 * FPS
-            else:
-                self.stoppedtime -= 1            
+            self.hud.show("stopped", "TIME STOPPED", (5, 290), (0,0,255))
+            self.hud.show("stopped_left", "SECONDS LEFT: {0}".format(self.stoppedtime // FPS), (5, 310), (0,0,255))
         
-        def display():
-            scoretext = myfont.render("P O T A T O  {0}".format(self.potato), 1, (255,255,255))
-            self.screen.blit(scoretext, (5, 210)) 
-            
-            scoretext = myfont.render("T I M E  L E F T  {0}".format(self.deadline // FPS), 1, (255,255,255))
-            self.screen.blit(scoretext, (5, 230))
-            
-            scoretext = myfont.render("D O N A T E D  {0}".format(self.donation), 1, (255,255,255))
-            self.screen.blit(scoretext, (5, 250)) 
+        def potatogrow():
+            self.crops.grow()
+        
+        pressed_key = self.pressed_key
+        for sprite in self.movers:
+            sprite.origin = None
+        self.apply_saves()
+        self.profiler.mark("saves")
+        for sprite in self.movers:
+            sprite.update()
+        if self.record_next and self.at_rest():
+            self.record_next = False
+            self.recorder = Recorder(self)
+        self.profiler.mark("sprites")
+        # If the player's animation is finished, check for keypresses
+        if self.player.animation is None:
+            self.control(keys)
+            self.player.update()
+        self.profiler.mark("control")
+        self.steer()
+        self.profiler.mark("paths")
+        for shadow in self.mover_shadows:
+            shadow.update()
+        self.profiler.mark("sprites")
+        
+        if self.is_time_stopped is True:
+            timestop()
+        self.timers.advance()
+                
+        if self.is_time_stopped is False:
+            self.clock.advance()
             
-            scoretext = myfont.render("G O A L  {0}".format(self.needed), 1, (255,255,255))
-            self.screen.blit(scoretext, (5, 270))            
+        if self.potato >= self.weightnum:
+            self.weight = True
+        else:
+            self.weight = False
+        self.profiler.mark("timers")
         
-        def potatogrow():
-            for j in self.bushstuff:
-                if j[1] is False and j[2] > 0:
-                    j[2] -= 1
-                if j[2] == 0 and j[1] is not True:
-                    j[1] = True
+        if self.is_time_stopped is False:
+            potatogrow()
+        self.profiler.mark("crops")
         
-        """Run the main loop."""
-        start_game()
+        if self.deadline == 0 and self.needed != 0:
+            self.game_over = True
+        if self.donation >= self.needed:
+            if self.levels is not None and self.levels.has_next():
+                self.next_level()
+            else:
+                self.good_ending = True
+                self.game_over = True
+        if self.recorder is not None:
+            self.recorder.record(keys, pressed_key, self.state_hash())
 
-        clock = pygame.time.Clock()
-        self.screen.blit(self.background, (0, 0))
-        self.overlays.draw(self.screen)
-        pygame.display.flip()
-           
-        pygame.mixer.music.stop()
-        music = pygame.mixer.Sound('music.wav')
-        music.play()                           
-        while not self.game_over:
-            myfont = pygame.font.SysFont("Ugo", 20)
-            self.screen.fill((0,0,0))
-                     
+    def state_hash(self):
+        """A checksum of the state of the game, to compare replays with."""
+        return zlib.crc32(self.save_state() + struct.pack(
+            "<ii", self.player.rect.x, self.player.rect.y))
+
+    def at_rest(self):
+        """Whether nobody is half way between two tiles."""
+        return (self.player.animation is None and
+                all(walker.animation is None for walker in self.walkers))
+
+    def toggle_recording(self):
+        """Start recording the keys of every tick, or write the recording.
+
+        The recording starts on the next tick that finds the game at rest.
+        """
+        if self.recorder is None:
+            self.record_next = not self.record_next
+            self.set_status("RECORDING" if self.record_next else "RECORDING OFF")
+        else:
+            self.saves.record(REPLAY_FILE, self.recorder.finish())
+            self.recorder = None
+
+    def main(self):
+        def display():
+            self.hud.show("potato", "P O T A T O  {0}".format(self.potato), (5, 210), (255,255,255))
             
-            if self.is_game_paused is True:
-                pausefont = pygame.font.SysFont("monospace", 16)
-                scoretext = pausefont.render("It is okay, gardener, take your time.", 1, (255,255,255))
-                self.screen.blit(scoretext, (MAP_TILE_WIDTH * 35 / 2 - 200, MAP_TILE_HEIGHT * 23 / 2))                
-                for event in pygame.event.get():
-                    if event.type == pg.KEYDOWN:    
-                        self.is_game_paused = False  
-                pygame.display.flip()
-                continue            
+            self.hud.show("time", "T I M E  L E F T  {0}".format(self.deadline // FPS), (5, 230), (255,255,255))
             
-            display()   
+            self.hud.show("donated", "D O N A T E D  {0}".format(self.donation), (5, 250), (255,255,255))
             
-            self.screen.blit(self.background, (0, 0))
-            # Don't clear shadows and overlays, only sprites.
-            self.sprites.clear(self.screen, self.background)
-            self.sprites.update()
-            # If the player's animation is finished, check for keypresses
-            if self.player.animation is None:
-                self.control()
-                self.player.update()
-            self.shadows.update()
-            # Don't add shadows to dirty rectangles, as they already fit inside
-            # sprite rectangles.
-            self.shadows.draw(self.screen)
-            dirty = self.sprites.draw(self.screen)
-            # Don't add ovelays to dirty rectangles, only the places where
-            # sprites are need to be updated, and those are already dirty.
-            self.overlays.draw(self.screen)
-            # Update the dirty areas of the screen
-            pygame.display.update(dirty)
-            # Wait for one tick of the game clock
-            clock.tick(15)
+            self.hud.show("goal", "G O A L  {0}".format(self.needed), (5, 270), (255,255,255))
+        
+        def show_profile():
+            # New numbers once a second, the text is rendered only then.
+            if self.timers.now % FPS == 0 or not self.profile_lines:
+                self.profile_lines = self.profiler.lines()
+                if self.sounds is not None and self.sounds.load_time is not None:
+                    self.profile_lines.append("{0:<8}{1:>7.2f}".format(
+                        "sounds", self.sounds.load_time * 1000))
+            for row, line in enumerate(self.profile_lines):
+                self.hud.show("profile{0}".format(row), line, (600, 5 + 16*row),
+                              (255,255,255), MESSAGE_FONT)
+
+        def show_screen(image, text=None):
+            self.screen.fill((0, 0, 0))
+            if image is not None:
+                rect = image.get_rect()
+                rect.center = (MAP_TILE_WIDTH * 35 / 2, MAP_TILE_HEIGHT * 23 / 2)
+                self.screen.blit(image, rect)
+            if text is not None:
+                scoretext = TEXT_CACHE.render(MESSAGE_FONT, text, (255,255,255))
+                self.screen.blit(scoretext, (MAP_TILE_WIDTH * 35 / 2 - 200, MAP_TILE_HEIGHT * 23 / 2))
+            pygame.display.flip()
+
+        def enter(scene):
+            self.scene = scene
+            if scene == "title":
+                show_screen(self.screens["start.png"])
+            elif scene == "paused":
+                show_screen(None, "It is okay, gardener, take your time.")
+            elif scene == "over":
+                # Do not lose a save or recording that is still going.
+                if self.recorder is not None:
+                    self.toggle_recording()
+                self.saves.wait()
+                if self.good_ending is True:
+                    show_screen(self.screens["win.png"])
+                else:
+                    show_screen(self.screens["end.png"])
+            elif scene == "play":
+                # The still screens covered everything, repaint it all, and
+                # do not count the time spent on them as game time.
+                self.drawn_camera = None
+                self.lag = 0.0
+                clock.tick()
+
+        def wait_events():
+            # The still screens sleep until something happens.
+            event = pygame.event.wait(IDLE_WAIT)
+            events = pygame.event.get()
+            if event.type != pg.NOEVENT:
+                events.insert(0, event)
+            return events
+
+        def title():
+            for event in wait_events():
+                if event.type == pg.QUIT:
+                    self.scene = None
+                    return
+                if event.type == pg.KEYDOWN:
+                    self.start_pressed = True
+            if not self.start_pressed:
+                return
+            if self.levels is not None and self.levels.index < 0:
+                if not self.levels.ready():
+                    show_screen(self.screens["start.png"], "Loading...")
+                    return
+                self.use_level(self.levels.next())
+            self.sounds.play_music('music.wav')
+            enter("play")
+
+        def paused():
+            for event in wait_events():
+                if event.type == pg.QUIT:
+                    self.game_over = True
+                    enter("over")
+                    return
+                if event.type == pg.KEYDOWN:
+                    self.is_game_paused = False
+                    enter("play")
+                    return
+
+        def over():
+            for event in wait_events():
+                if event.type in (pg.QUIT, pg.KEYDOWN):
+                    self.scene = None
+                    return
+
+        def play():
+            self.profiler.begin()
+            # Wait for the next frame, at most RENDER_FPS a second
+            self.lag += clock.tick(RENDER_FPS)
+            self.profiler.mark("wait")
             # Process pygame events               
-            
-            if self.is_time_stopped is True:
-                timestop()
-                    
-            if self.deadline != 0 and self.is_time_stopped is False:
-                self.deadline -= 1
-                
-            if self.potato >= self.weightnum:
-                self.weight = True
-            else:
-                self.weight = False
-            
-            if self.is_time_stopped is False:
-                potatogrow()
-            
-           
             for event in pygame.event.get():
-                if self.deadline == 0 and self.needed != 0:
-                    self.game_over = True
-                if self.donation >= self.needed:
-                    self.good_ending = True
-                    self.game_over = True
                 if event.type == pg.QUIT:
                     self.game_over = True
+                elif event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                    self.show_profile = not self.show_profile
+                elif event.type == pg.KEYDOWN and event.key == pg.K_F4:
+                    self.profiler.dump("profile.csv")
+                    self.profiler.dump("profile.json")
+                elif event.type == pg.KEYDOWN and event.key == pg.K_F5:
+                    self.toggle_recording()
                 elif event.type == pg.KEYDOWN:
                     self.pressed_key = event.key
-                    
-            pygame.display.flip()
-        game_over()
+            self.profiler.mark("events")
+            
+            # Run as many ticks as the time since the last frame is worth.
+            # Frames are dropped to catch up, but past MAX_CATCH_UP ticks
+            # the rest is thrown away and the game slows down instead.
+            if self.lag > MAX_CATCH_UP * tick_time:
+                self.dropped_ticks += int(self.lag // tick_time) - MAX_CATCH_UP
+                self.lag = MAX_CATCH_UP * tick_time
+            # Labels shown by any tick of the frame stay up until the
+            # next frame that ticks, so none is cleared before it is drawn.
+            if self.lag >= tick_time:
+                self.hud.begin()
+            while self.lag >= tick_time and not self.game_over and not self.is_game_paused:
+                self.lag -= tick_time
+                self.step(pygame.key.get_pressed())
+                display()
+                if self.show_profile:
+                    show_profile()
+                for bush in self.crops.take_changed():
+                    self.redraw.append(self.crop_rects[bush])
+                self.profiler.mark("hud")
+            if self.game_over:
+                enter("over")
+            elif self.is_game_paused:
+                enter("paused")
+            else:
+                # Update only the dirty areas of the screen
+                self.draw_frame(min(self.lag / tick_time, 1.0))
+            self.profiler.end()
+
+        """Run the scenes until the game-over screen is closed."""
+        clock = pygame.time.Clock()
+        tick_time = 1000.0 / FPS
+        # Milliseconds of game time that have not been ticked yet.
+        self.lag = 0.0
+        self.start_pressed = False
+        scenes = {"title": title, "play": play, "paused": paused, "over": over}
+        enter("title")
+        while self.scene is not None:
+            scenes[self.scene]()
+        self.saves.close()
+        pygame.display.quit()
+        pygame.quit()
             
         
                           
+SPRITE_CACHE = TileCache()
+MAP_CACHE = TileCache(MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
+TILE_CACHE = TileCache(32, 32)
+FONT_CACHE = FontCache()
+TEXT_CACHE = TextCache(FONT_CACHE)
+
+
 if __name__ == "__main__":
-    SPRITE_CACHE = TileCache()
-    MAP_CACHE = TileCache(MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
-    TILE_CACHE = TileCache(32, 32)
     pygame.init()
     pygame.display.set_mode((MAP_TILE_WIDTH * 35, MAP_TILE_HEIGHT * 23))
-    Game().main()
+    Game(levels=sys.argv[1:] or LEVELS).main()
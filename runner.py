@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Play many headless qq3 sessions in parallel, one worker per core.
+
+Every worker loads the level and the sprite images once, then plays the
+jobs it is given with headless.run_session. A job is a dict with the
+settings of the Game (see headless.SETTINGS), plus optionally "fps",
+"seed" for the random script to play and "ticks" for how long to run:
+
+    for job, result in runner.run_many(runner.sweep(weightnum=[100, 250])):
+        print(job, result["potato"], result["good_ending"])
+"""
+
+import itertools
+import multiprocessing
+import sys
+import time
+
+import headless
+import qq3
+
+_level = None
+_fps = None
+
+
+def _init_worker(map_file):
+    global _level, _fps
+    headless.init()
+    _fps = qq3.FPS
+    _level = qq3.Level(map_file)
+    for tile in _level.items.values():
+        qq3.SPRITE_CACHE[tile["sprite"]]
+    qq3.SPRITE_CACHE["shadow.png"]
+
+
+def _run_job(job):
+    settings = dict(job)
+    qq3.FPS = settings.pop("fps", _fps)
+    seed = settings.pop("seed", 0)
+    ticks = settings.pop("ticks", 200 * qq3.FPS)
+    script = headless.random_script(ticks, seed)
+    return job, headless.run_session(script, _level, max_ticks=ticks,
+                                     **settings)
+
+
+def sweep(seeds=1, **grid):
+    """Return a job for every combination of the listed values.
+
+    Each combination is played with seeds different random scripts.
+    """
+    names = sorted(grid)
+    jobs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for seed in range(seeds):
+            job = dict(zip(names, values))
+            job["seed"] = seed
+            jobs.append(job)
+    return jobs
+
+
+def run_many(jobs, processes=None, map_file="level.map", chunksize=8):
+    """Play jobs on a pool of processes, yielding (job, result) pairs.
+
+    Results come back as soon as they are done, not in the order of jobs.
+    """
+    with multiprocessing.Pool(processes, _init_worker, (map_file,)) as pool:
+        for job, result in pool.imap_unordered(_run_job, jobs, chunksize):
+            yield job, result
+
+
+def main(argv):
+    sessions = int(argv[0]) if argv else 400
+    jobs = sweep(seeds=sessions // 16, weightnum=[100, 250],
+                 maxcapacity=[300, 500], forward_cost=[10, 20],
+                 fps=[10, 15])
+    processes = 1
+    while processes <= multiprocessing.cpu_count():
+        start = time.perf_counter()
+        good = sum(result["good_ending"]
+                   for job, result in run_many(jobs, processes))
+        elapsed = time.perf_counter() - start
+        print("{0:>3} processes: {1} sessions in {2:.2f} s, {3:.0f} "
+              "sessions/min, {4} good endings".format(
+                  processes, len(jobs), elapsed, len(jobs) * 60 / elapsed,
+                  good))
+        processes *= 2
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])